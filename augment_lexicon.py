@@ -0,0 +1,104 @@
+'''
+Add the out of vocabulary words of a corpus to the lexicon, so that G2P is
+not needed at synthesis time for text like the corpus.
+
+Usage:
+    Words of the preprocessed train.txt and val.txt:
+    python3 augment_lexicon.py config/LJSpeech/preprocess.yaml --output lexicon/librispeech-augmented.txt
+
+    Words of text files, one or more sentences per line, compiled:
+    python3 augment_lexicon.py config/LJSpeech/preprocess.yaml --corpus prompts.txt --output lexicon/librispeech-augmented.bin
+
+Then set lexicon_path in the preprocess config to the output.
+'''
+
+import argparse
+import os
+import time
+import yaml
+
+from multiprocessing import Pool
+from synthesize import read_lexicon, oov_words
+from text.g2p import g2p_batch, load_g2p
+from text.lexicon import CompiledLexicon, compile_lexicon
+
+
+def read_corpus(paths):
+    """ lines of text files. the text of train.txt and val.txt is the last field """
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip("\n")
+                if os.path.basename(path) in ["train.txt", "val.txt"]:
+                    line = line.split("|")[-1]
+                yield line
+
+
+def init_worker(data_path):
+    global g2p
+    g2p = load_g2p(data_path)
+
+
+def convert(words):
+    return g2p_batch(g2p, words)
+
+
+def main(config, corpus, output, workers=None, chunk_size=256, g2p_data=None):
+    lexicon_path = config["path"]["lexicon_path"]
+    lexicon = read_lexicon(lexicon_path)
+    if len(corpus) == 0:
+        corpus = [os.path.join(config["path"]["preprocessed_path"], name) for name in ["train.txt", "val.txt"]]
+
+    # words are looked up lower case, G2P does not depend on the case either
+    start_time = time.time()
+    words = {}
+    lines = 0
+    for line in read_corpus(corpus):
+        lines += 1
+        for w in oov_words(lexicon, line.replace('-', ' '), config):
+            # delimiters and empty words can not be lexicon entries
+            if w.strip() == w and len(w) > 0:
+                words.setdefault(w.lower(), w)
+    print("{} lines, {} words not in {} ({:.2f}s)".format(lines, len(words), lexicon_path, time.time() - start_time))
+
+    start_time = time.time()
+    keys = list(words)
+    chunks = [[words[k] for k in keys[i:i + chunk_size]] for i in range(0, len(keys), chunk_size)]
+    with Pool(workers, initializer=init_worker, initargs=(g2p_data,)) as pool:
+        phones = [p for chunk in pool.map(convert, chunks) for p in chunk]
+    print("G2P of {} words in {:.2f}s".format(len(keys), time.time() - start_time))
+
+    text_path = os.path.splitext(output)[0] + ".txt" if output.endswith(".bin") else output
+    assert os.path.abspath(text_path) != os.path.abspath(lexicon_path), "the output would overwrite the lexicon"
+    with open(text_path, "w", encoding="utf-8") as f:
+        if isinstance(lexicon, CompiledLexicon):
+            for word, p in lexicon.items():
+                f.write("\t".join([word] + p) + "\n")
+        else:
+            with open(lexicon_path, encoding="utf-8") as lex:
+                for line in lex:
+                    f.write(line if line.endswith("\n") else line + "\n")
+        for word, p in zip(keys, phones):
+            # same phones as text2phoneme gets from G2P
+            f.write("\t".join([word] + [x for x in p if x != " "]) + "\n")
+    print("Wrote {} words to {}".format(len(lexicon) + len(keys), text_path))
+
+    if output.endswith(".bin"):
+        n = compile_lexicon(text_path, output)
+        print("Compiled {} words to {}".format(n, output))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config", type=str, help="path to preprocess.yaml")
+    parser.add_argument("--corpus", type=str, nargs="*", default=[],
+                        help="text files, default train.txt and val.txt of the preprocessed dataset")
+    parser.add_argument("--output", type=str, required=True,
+                        help="augmented lexicon, compiled if it ends with .bin")
+    parser.add_argument("--workers", type=int, default=None, help="G2P processes, default all cores")
+    parser.add_argument("--g2p-data", type=str, default=None,
+                        help="local NLTK data directory with cmudict, averaged_perceptron_tagger and, for NLTK 3.9 or later, averaged_perceptron_tagger_eng, nothing is downloaded")
+    args = parser.parse_args()
+
+    config = yaml.load(open(args.config, "r"), Loader=yaml.FullLoader)
+    main(config, args.corpus, args.output, workers=args.workers, g2p_data=args.g2p_data)
@@ -6,24 +6,71 @@ Apache 2.0 License
 
 Usage:
     python3 convert.py --checkpoint tiny_eng_266k.ckpt --onnx tiny_eng_266k.onnx
+
+    Split acoustic model and vocoder:
+    python3 convert.py --checkpoint tiny_eng_266k.ckpt --onnx tiny_eng_266k.onnx \
+        --onnx-vocoder hifigan_v2.onnx
+
+    Inference only HiFi-GAN with folded weights, loadable by get_hifigan as a
+    standalone vocoder. EfficientSpeech checkpoints keep the Generator weights,
+    use demo.py --freeze-vocoder to fold them after loading:
+    python3 convert.py --hifigan-checkpoint hifigan/LJ_V2/generator_v2 \
+        --hifigan-frozen hifigan/LJ_V2/generator_v2_frozen
 '''
 
+import inspect
+import os
+import shutil
 import torch
 import yaml
-from model import EfficientSpeech
+from model import EfficientSpeech, get_hifigan
 from utils.tools import get_args
 
+
+def freeze_hifigan(args):
+    vocoder = get_hifigan(args.hifigan_checkpoint, infer_device="cpu")
+    grouped = [i in args.hifigan_grouped for i in range(vocoder.num_upsamples)]
+    frozen = vocoder.freeze(grouped=grouped)
+
+    # parity, float64 shows the folding is exact up to rounding
+    mel = torch.randn(2, 80, 64)
+    mask = torch.zeros(2, 1, 64, dtype=torch.bool)
+    mask[1, :, 40:] = True
+    with torch.no_grad():
+        diff = (vocoder(mel, mask) - frozen(mel, mask)).abs().max().item()
+        vocoder = vocoder.double()
+        diff64 = (vocoder(mel.double(), mask) - vocoder.freeze(grouped=grouped)(mel.double(), mask)).abs().max().item()
+    print("Frozen HiFi-GAN max wav difference: {:.2e} (float32), {:.2e} (float64)".format(diff, diff64))
+
+    print("Saving frozen HiFi-GAN ...", args.hifigan_frozen)
+    torch.save({"generator": frozen.state_dict(), "grouped": grouped}, args.hifigan_frozen)
+    # get_hifigan reads config.json next to the checkpoint
+    config = os.path.join(os.path.dirname(os.path.abspath(args.hifigan_checkpoint)), "config.json")
+    folder = os.path.dirname(os.path.abspath(args.hifigan_frozen))
+    if not os.path.isfile(os.path.join(folder, "config.json")):
+        shutil.copy(config, folder)
+
+
 # main routine
 if __name__ == "__main__":
     args = get_args()
     preprocess_config = yaml.load(
         open(args.preprocess_config, "r"), Loader=yaml.FullLoader)
 
+    if args.hifigan_frozen is not None:
+        freeze_hifigan(args)
+        if args.checkpoint is None:
+            exit(0)
+
     model = EfficientSpeech(preprocess_config=preprocess_config)
     model = model.load_from_checkpoint(args.checkpoint, map_location=torch.device('cpu'))
     model = model.to(args.infer_device)
+    model.eval()
+    # pitch, energy and duration decoders share one conv stack
+    model.phoneme2mel.encoder.fuse_decoders()
 
     if args.onnx is not None:
+        # sample input only, the phoneme axis is dynamic
         phoneme = torch.randint(low=70, high=146, size=(1,args.onnx_insize)).int().to(args.infer_device)
         print("Input shape: ", phoneme.shape)
         sample_input = [{"phoneme": phoneme}, False]
@@ -32,14 +79,45 @@ if __name__ == "__main__":
         # https://pytorch.org/docs/stable/onnx.html#torch.onnx.export
         # or use model.to_onnx
         #model.to_onnx(args.onnx, sample_input, input_names="phoneme") #, export_params=True)
-        torch.onnx.export(model, sample_input, args.onnx,
-                          opset_version=args.onnx_opset, do_constant_folding=True,
-                          input_names=["inputs"], output_names=["outputs"],
-                          dynamic_axes={
-                              "inputs": {1: "phoneme"},
-                              # ideally, this works but repeat_interleave is fixed
-                              "outputs": {0: "wav", 1: "lengths", 2: "duration"}
-                          })
+        # the dynamo exporter, default since torch 2.9, can not convert the dynamic_axes
+        # of the dict input. use the torchscript exporter on every torch version
+        export_kwargs = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+        if args.onnx_vocoder is None:
+            torch.onnx.export(model, sample_input, args.onnx,
+                              opset_version=args.onnx_opset, do_constant_folding=True,
+                              **export_kwargs,
+                              input_names=["inputs"], 
+                              output_names=["wav", "lengths", "duration"],
+                              dynamic_axes={
+                                  "inputs": {1: "phoneme"},
+                                  "wav": {1: "samples"},
+                                  "duration": {1: "phoneme"},
+                              })
+        else:
+            # phoneme2mel and vocoder as separate graphs
+            torch.onnx.export(model.phoneme2mel, sample_input, args.onnx,
+                              opset_version=args.onnx_opset, do_constant_folding=True,
+                              **export_kwargs,
+                              input_names=["inputs"], 
+                              output_names=["mel", "lengths", "duration"],
+                              dynamic_axes={
+                                  "inputs": {1: "phoneme"},
+                                  "mel": {1: "frames"},
+                                  "duration": {1: "phoneme"},
+                              })
+
+            with torch.no_grad():
+                mel = model.phoneme2mel(sample_input)[0].transpose(1, 2)
+            print("Converting vocoder to ONNX ...", args.onnx_vocoder)
+            torch.onnx.export(model.hifigan, mel, args.onnx_vocoder,
+                              opset_version=args.onnx_opset, do_constant_folding=True,
+                              **export_kwargs,
+                              input_names=["mel"], 
+                              output_names=["wav"],
+                              dynamic_axes={
+                                  "mel": {0: "batch", 2: "frames"},
+                                  "wav": {0: "batch", 2: "samples"},
+                              })
     elif args.jit is not None:
         with torch.no_grad():
             print("Converting to JIT ...", args.jit)
@@ -11,60 +11,53 @@ Usage:
 
     ONNX:
     python3 demo.py --checkpoint tiny_eng_266k.onnx --infer-device cuda  --text "In additive color mixing, which is used for displays such as computer screens and televisions, the primary colors are red, green, and blue."  --wav-filename color.wav
+
+    Torch, streaming sentence by sentence:
+    python3 demo.py --checkpoint tiny_eng_266k.ckpt --infer-device cpu --stream --play --verbose --text "the primary colors are red, green, and blue. They are additive."
+
+    ONNX, split acoustic model and vocoder:
+    python3 demo.py --checkpoint tiny_eng_266k.onnx --onnx-vocoder hifigan_v2.onnx --infer-device cpu --text "the primary colors are red, green, and blue." --wav-filename primary.wav
     
 Additional dependencies for GUI:
     pip3 install pysimplegui
     pip3 install sounddevice 
 '''
 
+import os
 import torch
 import yaml
 import time
 import numpy as np
 import validators
 
-
+from scipy.io import wavfile
 from model import EfficientSpeech
+from engine import ONNXEngine, CompiledEngine
+from layers.blocks import polyphase
 from utils.tools import get_args, write_to_file
-from synthesize import get_lexicon_and_g2p, text2phoneme
+from synthesize import get_lexicon_and_g2p, text2sequence, synthesize_stream
 
 def tts(lexicon, g2p, preprocess_config, model, is_onnx, args, verbose=False):
     text = args.text.strip()
     text = text.replace('-', ' ')
-    phoneme = np.array(
-            [text2phoneme(lexicon, g2p, text, preprocess_config, verbose=args.verbose)], dtype=np.int32)
+    phoneme = text2sequence(lexicon, g2p, text, preprocess_config, verbose=args.verbose)[None]
+    if args.verbose and not is_onnx:
+        window = model.phoneme2mel.encoder.window if isinstance(model, EfficientSpeech) else None
+        if window is not None and phoneme.shape[1] > window:
+            print("{} phonemes > {}, using windowed encoding".format(phoneme.shape[1], window))
     start_time = time.time()
     if is_onnx:
         # onnx is 3.5x faster than pytorch models
-        phoneme_len = phoneme.shape[1]
-        
-        text = text + 2*args.onnx_insize*'- '
-        phoneme = np.array(
-            [text2phoneme(lexicon, g2p, text, preprocess_config, verbose=args.verbose)], dtype=np.int32)
-        
-        # unfortunately, due to call to repeat_interleave(), dynamic axis is not supported
-        # so, the input size must be fixed to args.onnx_insize=128 (can be configured)
-        phoneme = phoneme[:, :args.onnx_insize]
-        
-        ort_inputs = {model.get_inputs()[0].name: phoneme}
-        outputs = model.run(None, ort_inputs)
-        wavs = outputs[0]
-        hop_len = preprocess_config["preprocessing"]["stft"]["hop_length"]
-        lengths = outputs[1]
-        
-        duration = outputs[2]
-        orig_duration = int(np.sum(np.round(duration.squeeze())[:phoneme_len])) * hop_len
-        
-        # crude estimate of duration
-        # orig_duration = int(lengths*phoneme_len/args.onnx_insize) * hop_len
-        
-        # truncate the wav file to the original duration
-        wavs = wavs[:, :orig_duration]
-        lengths = [orig_duration]
+        # phoneme and wav axes are dynamic, no padding or truncation is needed
+        wavs, lengths, _ = model(phoneme)
     else:
         with torch.no_grad():
             phoneme = torch.from_numpy(phoneme).int().to(args.infer_device)
-            wavs, lengths, _ = model({"phoneme": phoneme})
+            if args.sparse:
+                wavs, lengths, _ = model.predict_sparse({"phoneme": phoneme}, 
+                                                        energy_threshold=args.silence_energy)
+            else:
+                wavs, lengths, _ = model({"phoneme": phoneme})
             wavs = wavs.cpu().numpy()
             lengths = lengths.cpu().numpy()
         
@@ -93,7 +86,8 @@ if __name__ == "__main__":
     preprocess_config = yaml.load(
         open(args.preprocess_config, "r"), Loader=yaml.FullLoader)
  
-    lexicon, g2p = get_lexicon_and_g2p(preprocess_config)
+    lexicon, g2p = get_lexicon_and_g2p(preprocess_config, g2p_cache=args.g2p_cache,
+                                       g2p_data=args.g2p_data, verbose=args.verbose)
     sampling_rate = preprocess_config["preprocessing"]["audio"]["sampling_rate"]
     is_onnx = False
 
@@ -105,14 +99,9 @@ if __name__ == "__main__":
 
 
     if "onnx" in checkpoint:
-        import onnxruntime
-        import onnx
-
-        onnx_model = onnx.load(checkpoint)
-        onnx.checker.check_model(onnx_model)
-
-        ort_session = onnxruntime.InferenceSession(checkpoint)
-        model = ort_session
+        model = ONNXEngine(checkpoint, 
+                           vocoder_checkpoint=args.onnx_vocoder,
+                           intra_op_threads=args.threads)
         is_onnx = True
     else:
         model = EfficientSpeech(preprocess_config=preprocess_config, 
@@ -126,15 +115,36 @@ if __name__ == "__main__":
 
         model = model.to(args.infer_device)
         model.eval()
+
+        encoder = model.phoneme2mel.encoder
+        # inference only layers, built from the loaded weights
+        encoder.fuse_decoders()
+        if args.channels_last:
+            model.phoneme2mel.channels_last()
+        if args.freeze_vocoder:
+            grouped = [i in args.hifigan_grouped for i in range(model.hifigan.num_upsamples)]
+            model.hifigan = model.hifigan.freeze(grouped=grouped)
+        if args.verbose:
+            print("Vocoder: {}".format(type(model.hifigan).__name__))
+        if args.polyphase:
+            polyphase(model.hifigan)
+            polyphase(encoder.fuse)
+        model.vocoder_workers = args.vocoder_workers
+        model.vocoder_threads = args.vocoder_threads
+
+        # bounded attention memory for long inputs
+        encoder.window = args.encoder_window if args.encoder_window > 0 else None
+        if args.verbose and encoder.window is not None:
+            print("Windowed encoding for inputs longer than {} phonemes".format(encoder.window))
         
         # default number of threads is 128 on AMD
         # this is too high and causes the model to run slower
         # set it to a lower number eg --threads 24 
         # https://pytorch.org/docs/stable/notes/cpu_threading_torchscript_inference.html
-        if args.threads is not None:
-            torch.set_num_threads(args.threads)
+        torch.set_num_threads(args.threads if args.threads is not None else 24)
         if args.compile:
-            model = torch.compile(model, mode="reduce-overhead", backend="inductor")
+            # padded to shape buckets, compiled and warmed up before the 1st request
+            model = CompiledEngine(model, cache_dir=args.compile_cache, verbose=args.verbose)
             
     if args.play:
         import sounddevice as sd
@@ -145,7 +155,25 @@ if __name__ == "__main__":
         sd.default.device = None
         sd.default.latency = 'low'
 
-    if args.text is not None:
+    if args.sparse:
+        assert not is_onnx and not args.compile, "--sparse needs an uncompiled torch checkpoint"
+
+    if args.text is not None and args.stream:
+        assert not is_onnx, "--stream needs a torch checkpoint"
+        if args.compile:
+            model = model.model
+        chunks = synthesize_stream(lexicon, g2p, args.text, model, preprocess_config,
+                                   chunk_size=args.chunk_size, verbose=args.verbose)
+        if args.play:
+            with sd.OutputStream() as stream:
+                for chunk in chunks:
+                    stream.write(chunk)
+        else:
+            os.makedirs(args.wav_path, exist_ok=True)
+            path = os.path.join(args.wav_path, args.wav_filename)
+            print("Writing wav to {}".format(path))
+            wavfile.write(path, sampling_rate, np.concatenate(list(chunks)))
+    elif args.text is not None:
         rtf = []
         warmup = 10
         for  i in range(args.iter):
@@ -167,4 +195,7 @@ if __name__ == "__main__":
             print("Average RTF: {:.2f}".format(mean_rtf))  
     else:
         print("Nothing to synthesize. Please provide a text file with --text")
+
+    if args.g2p_cache is not None:
+        g2p.save()
     
\ No newline at end of file
@@ -0,0 +1,236 @@
+'''
+EfficientSpeech: An On-Device Text to Speech Model
+https://ieeexplore.ieee.org/abstract/document/10094639
+Rowel Atienza
+Apache 2.0 License
+2023
+
+Inference engines for exported and compiled models.
+'''
+
+import os
+import bisect
+import hashlib
+import numpy as np
+import torch
+
+from utils.tools import get_mask_from_lengths
+
+
+class ONNXEngine:
+    """
+    onnxruntime engine for an exported EfficientSpeech model.
+
+    Supports the single text-ID->waveform graph or the split export,
+    an acoustic graph (phoneme -> mel, lengths, duration) and a vocoder
+    graph (mel -> wav). Sessions are created once and io bindings are
+    reused across calls.
+    """
+
+    def __init__(self,
+                 checkpoint,
+                 vocoder_checkpoint=None,
+                 intra_op_threads=None,
+                 inter_op_threads=None,
+                 graph_optimization_level="all",
+                 providers=None):
+        import onnxruntime
+
+        levels = {"disable": onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+                  "basic": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+                  "extended": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+                  "all": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL}
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = levels[graph_optimization_level]
+        if intra_op_threads is not None:
+            options.intra_op_num_threads = intra_op_threads
+        if inter_op_threads is not None:
+            options.inter_op_num_threads = inter_op_threads
+        if providers is None:
+            providers = ["CPUExecutionProvider"]
+
+        self.session = onnxruntime.InferenceSession(checkpoint, options, providers=providers)
+        self.binding = self.session.io_binding()
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_names = [o.name for o in self.session.get_outputs()]
+
+        self.vocoder = None
+        if vocoder_checkpoint is not None:
+            self.vocoder = onnxruntime.InferenceSession(vocoder_checkpoint, options, providers=providers)
+            self.vocoder_binding = self.vocoder.io_binding()
+            self.vocoder_input_name = self.vocoder.get_inputs()[0].name
+            self.vocoder_output_name = self.vocoder.get_outputs()[0].name
+            # wav samples per mel frame, known after the 1st call
+            self.hop_length = None
+            self.wav_buffer = None
+
+    def run_acoustic(self, phoneme):
+        """ phoneme (1, N) int32 -> outputs of the acoustic (or single) graph """
+        phoneme = np.ascontiguousarray(phoneme, dtype=np.int32)
+        self.binding.bind_cpu_input(self.input_name, phoneme)
+        for name in self.output_names:
+            self.binding.bind_output(name)
+        self.session.run_with_iobinding(self.binding)
+        return self.binding.copy_outputs_to_cpu()
+
+    def run_vocoder(self, mel):
+        """
+        mel (B, 80, T) float32 -> wav (B, T*hop_length).
+
+        The returned array is reused by the next call with the same shape.
+        """
+        mel = np.ascontiguousarray(mel, dtype=np.float32)
+        self.vocoder_binding.bind_cpu_input(self.vocoder_input_name, mel)
+        if self.hop_length is None:
+            self.vocoder_binding.bind_output(self.vocoder_output_name)
+            self.vocoder.run_with_iobinding(self.vocoder_binding)
+            wav = self.vocoder_binding.copy_outputs_to_cpu()[0]
+            self.hop_length = wav.shape[-1] // mel.shape[-1]
+            self.wav_buffer = wav
+            return wav.reshape(wav.shape[0], -1)
+
+        shape = (mel.shape[0], 1, mel.shape[-1] * self.hop_length)
+        if self.wav_buffer.shape != shape:
+            self.wav_buffer = np.empty(shape, dtype=np.float32)
+        self.vocoder_binding.bind_output(self.vocoder_output_name, "cpu", 0, np.float32,
+                                         shape, self.wav_buffer.ctypes.data)
+        self.vocoder.run_with_iobinding(self.vocoder_binding)
+        return self.wav_buffer.reshape(shape[0], -1)
+
+    def __call__(self, phoneme):
+        """ phoneme (1, N) int32 -> wav (1, samples), lengths (1,), duration (1, N, 1) """
+        if self.vocoder is None:
+            wav, lengths, duration = self.run_acoustic(phoneme)
+            return wav, lengths, duration
+
+        mel, lengths, duration = self.run_acoustic(phoneme)
+        wav = self.run_vocoder(mel.transpose(0, 2, 1))
+        return wav, lengths, duration
+
+
+class CompiledEngine:
+    """
+    torch.compile engine with shape buckets.
+
+    Phonemes are padded to the smallest phoneme bucket and mel frames to
+    frames_per_phoneme x bucket, so every request reuses one of a few static
+    graphs. The vocoder runs on the smallest frame bucket that holds the 
+    predicted mel. Compiled artefacts are persisted under cache_dir, keyed 
+    by model hash and torch version, and all buckets are warmed up at start.
+    """
+
+    def __init__(self,
+                 model,
+                 phoneme_buckets=(16, 32, 64, 128, 256, 512),
+                 frame_buckets=(64, 96, 128, 192, 256, 384, 512, 768, 1024, 1536, 2048, 3072, 4096),
+                 frames_per_phoneme=8,
+                 cache_dir=os.path.join("~", ".cache", "efficientspeech"),
+                 mode=None,
+                 warmup=True,
+                 verbose=False):
+        self.model = model
+        self.phoneme_buckets = sorted(phoneme_buckets)
+        self.frame_buckets = sorted(frame_buckets)
+        self.frames_per_phoneme = frames_per_phoneme
+        self.hop_length = model.hparams.preprocess_config["preprocessing"]["stft"]["hop_length"]
+        self.device = model.device
+        self.verbose = verbose
+
+        # inductor writes its caches here, so set it before anything is compiled
+        self.cache_dir = os.path.join(os.path.expanduser(cache_dir), 
+                                      f"{self.model_hash()}-torch{torch.__version__}")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        os.environ["TORCHINDUCTOR_CACHE_DIR"] = self.cache_dir
+        self.load_cache()
+
+        # one graph per acoustic bucket and per vocoder bucket
+        limit = 2 * (len(self.phoneme_buckets) + len(self.frame_buckets))
+        torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, limit)
+        self.phoneme2mel = torch.compile(model.phoneme2mel, dynamic=False, mode=mode)
+        self.hifigan = torch.compile(model.hifigan, dynamic=False, mode=mode)
+
+        if warmup:
+            self.warmup()
+            self.save_cache()
+
+    def model_hash(self):
+        sha = hashlib.sha256()
+        for name, tensor in self.model.state_dict().items():
+            sha.update(name.encode())
+            sha.update(tensor.detach().cpu().numpy().tobytes())
+        return sha.hexdigest()[:16]
+
+    def load_cache(self):
+        path = os.path.join(self.cache_dir, "artifacts.bin")
+        if os.path.isfile(path) and hasattr(torch.compiler, "load_cache_artifacts"):
+            with open(path, "rb") as f:
+                torch.compiler.load_cache_artifacts(f.read())
+            if self.verbose:
+                print("Loaded compile cache: ", path)
+
+    def save_cache(self):
+        if not hasattr(torch.compiler, "save_cache_artifacts"):
+            return
+        artifacts = torch.compiler.save_cache_artifacts()
+        if artifacts is not None:
+            path = os.path.join(self.cache_dir, "artifacts.bin")
+            with open(path, "wb") as f:
+                f.write(artifacts[0])
+            if self.verbose:
+                print("Saved compile cache: ", path)
+
+    def warmup(self):
+        with torch.no_grad():
+            for bucket in self.phoneme_buckets:
+                if self.verbose:
+                    print("Warming up phoneme bucket: ", bucket)
+                phoneme = torch.ones((1, bucket), dtype=torch.long, device=self.device)
+                self.acoustic(phoneme, bucket * self.frames_per_phoneme)
+            for frames in self.frame_buckets:
+                if self.verbose:
+                    print("Warming up frame bucket: ", frames)
+                mel = torch.zeros((1, frames, 80), device=self.device)
+                mel_len = torch.tensor([frames], device=self.device)
+                self.vocoder(mel, mel_len)
+
+    def acoustic(self, phoneme, max_mel_len):
+        length = phoneme.shape[1]
+        bucket = self.phoneme_buckets[bisect.bisect_left(self.phoneme_buckets, length)]
+        phoneme_len = torch.tensor([length], device=self.device)
+        phoneme_mask = get_mask_from_lengths(phoneme_len, bucket)
+        phoneme = torch.nn.functional.pad(phoneme, (0, bucket - length))
+        mel, mel_len, duration = self.phoneme2mel({"phoneme": phoneme,
+                                                   "phoneme_mask": phoneme_mask,
+                                                   "max_mel_len": max_mel_len})
+        return mel, mel_len, duration[:, :length]
+
+    def vocoder(self, mel, mel_len):
+        length = int(mel_len[0])
+        frames = self.frame_buckets[bisect.bisect_left(self.frame_buckets, length)]
+        mel = torch.nn.functional.pad(mel[:, :length], (0, 0, 0, frames - length))
+        mask = get_mask_from_lengths(mel_len, frames).unsqueeze(1)
+        wav = self.hifigan(mel.transpose(1, 2), mask=mask).squeeze(1)
+        return wav[:, :length * self.hop_length]
+
+    def __call__(self, x):
+        """ same input and outputs as EfficientSpeech inference, batch size 1 """
+        phoneme = x["phoneme"].long()
+        if phoneme.shape[1] > self.phoneme_buckets[-1]:
+            # too long for any bucket, use the eager model
+            return self.model(x)
+
+        max_mel_len = self.frames_per_phoneme * \
+            self.phoneme_buckets[bisect.bisect_left(self.phoneme_buckets, phoneme.shape[1])]
+        mel, mel_len, duration = self.acoustic(phoneme, max_mel_len)
+        if int(mel_len[0]) > max_mel_len:
+            # rare, speech is slower than frames_per_phoneme. a larger max_mel_len
+            # would be a shape warmup did not compile, use the eager model
+            return self.model(x)
+
+        if int(mel_len[0]) > self.frame_buckets[-1]:
+            mel = mel[:, :int(mel_len[0])].transpose(1, 2)
+            wav = self.model.hifigan(mel).squeeze(1)
+        else:
+            wav = self.vocoder(mel, mel_len)
+        return wav, mel_len, duration
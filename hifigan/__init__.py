@@ -1,4 +1,4 @@
-from .models import Generator
+from .models import Generator, FrozenGenerator
 
 
 class AttrDict(dict):
@@ -1,3 +1,5 @@
+import math
+from concurrent.futures import ThreadPoolExecutor
 import torch
 import torch.nn.functional as F
 import torch.nn as nn
@@ -16,6 +18,24 @@ def get_padding(kernel_size, dilation=1):
 
 LRELU_SLOPE = 0.1
 
+# (workers, threads) -> ThreadPoolExecutor of Generator.vocode_parallel. kept
+# across calls so the workers keep their intra-op thread pools, and off the
+# modules so they can still be copied and saved
+_vocoder_pools = {}
+
+
+def conv_radius(conv):
+    # one-sided receptive field of a stride 1 conv
+    return conv.dilation[0] * (conv.kernel_size[0] - 1) // 2
+
+
+def mask_padding(x, mask=None):
+    # zero padded time steps so that convs see the same zero padding
+    # as an unpadded sequence
+    if mask is None:
+        return x
+    return x.masked_fill(mask, 0)
+
 
 class ResBlock1(torch.nn.Module):
     def __init__(self, h, channels, kernel_size=3, dilation=(1, 3, 5)):
@@ -41,15 +61,18 @@ class ResBlock1(torch.nn.Module):
         ])
         self.convs2.apply(init_weights)
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
         for c1, c2 in zip(self.convs1, self.convs2):
             xt = F.leaky_relu(x, LRELU_SLOPE)
-            xt = c1(xt)
+            xt = c1(mask_padding(xt, mask))
             xt = F.leaky_relu(xt, LRELU_SLOPE)
-            xt = c2(xt)
+            xt = c2(mask_padding(xt, mask))
             x = xt + x
         return x
 
+    def receptive_field(self):
+        return sum(conv_radius(c) for c in self.convs1) + sum(conv_radius(c) for c in self.convs2)
+
     def remove_weight_norm(self):
         for l in self.convs1:
             remove_weight_norm(l)
@@ -69,13 +92,16 @@ class ResBlock2(torch.nn.Module):
         ])
         self.convs.apply(init_weights)
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
         for c in self.convs:
             xt = F.leaky_relu(x, LRELU_SLOPE)
-            xt = c(xt)
+            xt = c(mask_padding(xt, mask))
             x = xt + x
         return x
 
+    def receptive_field(self):
+        return sum(conv_radius(c) for c in self.convs)
+
     def remove_weight_norm(self):
         for l in self.convs:
             remove_weight_norm(l)
@@ -106,24 +132,230 @@ class Generator(torch.nn.Module):
         self.ups.apply(init_weights)
         self.conv_post.apply(init_weights)
 
-    def forward(self, x):
-        x = self.conv_pre(x)
+    def forward(self, x, mask=None):
+        # mask: optional (B, 1, T) bool, True on padded mel frames of a batch
+        x = self.conv_pre(mask_padding(x, mask))
         for i in range(self.num_upsamples):
             x = F.leaky_relu(x, LRELU_SLOPE)
-            x = self.ups[i](x)
-            xs = None
-            for j in range(self.num_kernels):
-                if xs is None:
-                    xs = self.resblocks[i*self.num_kernels+j](x)
-                else:
-                    xs += self.resblocks[i*self.num_kernels+j](x)
-            x = xs / self.num_kernels
+            x = self.ups[i](mask_padding(x, mask))
+            if mask is not None:
+                mask = mask.repeat_interleave(self.h.upsample_rates[i], dim=-1)
+            x = self.resblocks_forward(i, x, mask)
         x = F.leaky_relu(x)
-        x = self.conv_post(x)
+        x = self.conv_post(mask_padding(x, mask))
         x = torch.tanh(x)
 
         return x
 
+    def resblocks_forward(self, i, x, mask=None):
+        # average of the parallel resblocks of upsampling level i
+        xs = None
+        for j in range(self.num_kernels):
+            if xs is None:
+                xs = self.resblocks[i*self.num_kernels+j](x, mask)
+            else:
+                xs += self.resblocks[i*self.num_kernels+j](x, mask)
+        return xs / self.num_kernels
+
+    def resblocks_receptive_field(self, i):
+        resblocks = self.resblocks[i*self.num_kernels:(i+1)*self.num_kernels]
+        return max(l.receptive_field() for l in resblocks)
+
+    def receptive_field(self):
+        """ one-sided receptive field of an output sample, in mel frames """
+        r = conv_radius(self.conv_post)
+        for i in reversed(range(self.num_upsamples)):
+            r += self.resblocks_receptive_field(i)
+            # back to the input rate of the transposed conv
+            k, u, p = self.ups[i].kernel_size[0], self.ups[i].stride[0], self.ups[i].padding[0]
+            r = (r + max(p, k - 1 - p)) // u + 1
+        return r + conv_radius(self.conv_pre)
+
+    def hop_length(self):
+        hop_length = 1
+        for u in self.h.upsample_rates:
+            hop_length *= u
+        return hop_length
+
+    def vocode_chunk(self, mel, start, end, offset=0):
+        """
+        Wav of the mel frames [start, end), vocoded with receptive_field()
+        frames of context on both sides where mel has them, so it equals the
+        same samples of self(mel). offset is the frame index of mel[..., 0].
+        """
+        context = self.receptive_field()
+        hop_length = self.hop_length()
+        lo = max(start - context, offset)
+        hi = min(end + context, offset + mel.shape[-1])
+        wav = self(mel[..., lo - offset:hi - offset])
+        return wav[..., (start - lo) * hop_length:(end - lo) * hop_length]
+
+    def stream(self, mels, chunk_size=32):
+        """
+        Vocode mel chunks as they arrive and yield wav chunks of chunk_size frames.
+
+        Each chunk is vocoded with receptive_field() frames of context on both
+        sides so the concatenated output equals self(mel).
+
+        Args:
+            mels: (B, 80, T) mel or an iterable of (B, 80, t) mel chunks
+            chunk_size: mel frames per yielded wav chunk
+
+        Yields:
+            (B, 1, chunk_size * hop_length) wav, the last chunk may be shorter
+        """
+        if torch.is_tensor(mels):
+            mels = mels.split(chunk_size, dim=-1)
+
+        context = self.receptive_field()
+        buffer = None
+        # absolute frame index of buffer[..., 0] and of the next frame to vocode
+        offset = 0
+        start = 0
+
+        for mel in mels:
+            buffer = mel if buffer is None else torch.cat([buffer, mel], dim=-1)
+            while offset + buffer.shape[-1] >= start + chunk_size + context:
+                yield self.vocode_chunk(buffer, start, start + chunk_size, offset)
+                start += chunk_size
+                # keep only the left context of the next chunk
+                drop = max(0, start - context - offset)
+                buffer = buffer[..., drop:]
+                offset += drop
+
+        if buffer is None:
+            return
+        # end of utterance, no right context needed
+        while start < offset + buffer.shape[-1]:
+            end = min(start + chunk_size, offset + buffer.shape[-1])
+            yield self.vocode_chunk(buffer, start, end, offset)
+            start = end
+
+    def vocode_parallel(self, mel, workers=None, threads=1, chunk_size=None):
+        """
+        Vocode a long mel as overlapping chunks on a pool of worker threads.
+        Each chunk is vocoded with receptive_field() frames of context on both
+        sides, as in stream(), so the concatenated output equals self(mel).
+        Torch ops release the GIL, so the chunks run concurrently, each with
+        threads intra-op threads.
+
+        Args:
+            mel: (B, 80, T) unpadded mel
+            workers: number of worker threads, default torch.get_num_threads() // threads
+            threads: intra-op threads per worker
+            chunk_size: mel frames per chunk, default T / workers but at
+                least 4 * receptive_field() to bound the context overhead
+
+        Returns:
+            (B, 1, T * hop_length) wav
+        """
+        num_threads = torch.get_num_threads()
+        if workers is None:
+            workers = max(num_threads // threads, 1)
+        n = mel.shape[-1]
+        if chunk_size is None:
+            chunk_size = max(-(-n // workers), 4 * self.receptive_field())
+        if workers == 1 or chunk_size >= n:
+            return self(mel)
+
+        def vocode(start):
+            # grad mode is thread local
+            with torch.no_grad():
+                return self.vocode_chunk(mel, start, min(start + chunk_size, n))
+
+        key = (workers, threads)
+        if key not in _vocoder_pools:
+            _vocoder_pools[key] = ThreadPoolExecutor(max_workers=workers,
+                                                     initializer=torch.set_num_threads,
+                                                     initargs=(threads,))
+        try:
+            wavs = list(_vocoder_pools[key].map(vocode, range(0, n, chunk_size)))
+        finally:
+            # set_num_threads in the workers also sets the default of new threads
+            torch.set_num_threads(num_threads)
+        return torch.cat(wavs, dim=-1)
+
+    def silence(self, frames, like):
+        """
+        Wav of frames mel frames at the log mel floor, like is a tensor with the
+        device and dtype to use. A constant mel gives a wav that repeats every
+        hop_length samples, so one period is vocoded and tiled. The period is
+        cached until the weights change (load_state_dict, polyphase, .to()).
+        """
+        # in place updates bump _version, replaced or moved weights have a new data_ptr
+        key = (like.device, like.dtype) + tuple((p.data_ptr(), p._version) for p in self.parameters())
+        if getattr(self, "_silence", (None,))[0] != key:
+            context = self.receptive_field()
+            hop_length = self.hop_length()
+            # log(1e-5), the clip value of the hifigan mel
+            mel = like.new_full((1, self.conv_pre.in_channels, 2 * context + 1), math.log(1e-5))
+            self._silence = (key, self(mel)[0, 0, context * hop_length:(context + 1) * hop_length])
+        return self._silence[1].repeat(frames)
+
+    def vocode_sparse(self, mel, silent, min_silence=None, crossfade=2):
+        """
+        Vocode only the voiced parts of a mel and splice in precomputed
+        silence for long silent spans. Voiced islands are vocoded with
+        receptive_field() frames of context, so they match self(mel), and
+        extend crossfade frames into each skipped span where they are
+        crossfaded with the silence.
+
+        Args:
+            mel: (1, 80, T) mel
+            silent: (T,) bool, True on silent frames
+            min_silence: shortest silent span to skip, in frames. Each skipped
+                span still vocodes 2 * (receptive_field() + crossfade) frames,
+                the default 3 * (receptive_field() + crossfade) skips at least
+                as many as that
+            crossfade: crossfade length in frames
+
+        Returns:
+            (1, 1, T * hop_length) wav
+        """
+        context = self.receptive_field()
+        hop_length = self.hop_length()
+        if min_silence is None:
+            min_silence = 3 * (context + crossfade)
+        assert min_silence > 2 * crossfade, "min_silence must be longer than 2 * crossfade"
+
+        # silent spans [start, end) of at least min_silence frames
+        n = mel.shape[-1]
+        edges = torch.diff(F.pad(silent.int(), (1, 1))).nonzero().flatten().tolist()
+        spans = [(s, e) for s, e in zip(edges[::2], edges[1::2]) if e - s >= min_silence]
+        if len(spans) == 0:
+            return self(mel)
+
+        wav = self.silence(n, mel)
+        # voiced islands between the skipped spans
+        bounds = [0] + [b for span in spans for b in span] + [n]
+        for start, end in zip(bounds[::2], bounds[1::2]):
+            if start == end:
+                continue
+            head = crossfade if start > 0 else 0
+            tail = crossfade if end < n else 0
+            x = self.vocode_chunk(mel, start - head, end + tail)[0, 0]
+            if head > 0:
+                fade = torch.linspace(0, 1, head * hop_length + 2, dtype=x.dtype, device=x.device)[1:-1]
+                silence = wav[(start - head) * hop_length:start * hop_length]
+                x[:head * hop_length] = torch.lerp(silence, x[:head * hop_length], fade)
+            if tail > 0:
+                fade = torch.linspace(1, 0, tail * hop_length + 2, dtype=x.dtype, device=x.device)[1:-1]
+                silence = wav[end * hop_length:(end + tail) * hop_length]
+                x[-tail * hop_length:] = torch.lerp(silence, x[-tail * hop_length:], fade)
+            wav[(start - head) * hop_length:(end + tail) * hop_length] = x
+
+        return wav.view(1, 1, -1)
+
+    def freeze(self, grouped=None):
+        """
+        Inference only FrozenGenerator with the weights of this generator.
+        Weight norm must be removed first. grouped: per upsampling level, run
+        the parallel resblocks as grouped convs.
+        """
+        frozen = FrozenGenerator(self.h, grouped=grouped).to(self.conv_pre.weight)
+        frozen.load_generator(self)
+        return frozen.eval()
+
     def remove_weight_norm(self):
         print('Removing weight norm...')
         for l in self.ups:
@@ -134,6 +366,163 @@ class Generator(torch.nn.Module):
         remove_weight_norm(self.conv_post)
 
 
+class FrozenResBlocks(torch.nn.Module):
+    """
+    The num_kernels parallel resblocks of one upsampling level, inference only.
+
+    The leaky_relu of the shared input is computed once for all branches and
+    the 1/num_kernels average is left to the next conv (see FrozenGenerator).
+    With grouped=True, the branches run as one grouped conv per stage with
+    kernels zero-padded to the largest size. That needs the same dilations 
+    in all branches and is only faster where channels are wide.
+    """
+    def __init__(self, h, channels, grouped=False):
+        super(FrozenResBlocks, self).__init__()
+        self.h = h
+        self.channels = channels
+        self.grouped = grouped
+        kernel_sizes = h.resblock_kernel_sizes
+        # stages of each branch, one residual add per stage
+        if h.resblock == '1':
+            self.dilations = [[(d, 1) for d in dilation] for dilation in h.resblock_dilation_sizes]
+        else:
+            self.dilations = [[(d,) for d in dilation] for dilation in h.resblock_dilation_sizes]
+
+        if grouped:
+            assert all(d == self.dilations[0] for d in self.dilations), \
+                "grouped resblocks need the same dilations in all branches"
+            n, k = len(kernel_sizes), max(kernel_sizes)
+            self.convs = nn.ModuleList([nn.ModuleList([
+                Conv1d(n*channels, n*channels, k, 1, dilation=d, padding=get_padding(k, d), groups=n) 
+                for d in stage]) for stage in self.dilations[0]])
+        else:
+            self.convs = nn.ModuleList([nn.ModuleList([nn.ModuleList([
+                Conv1d(channels, channels, k, 1, dilation=d, padding=get_padding(k, d)) 
+                for d in stage]) for stage in dilations]) 
+                for k, dilations in zip(kernel_sizes, self.dilations)])
+
+    @torch.no_grad()
+    def load_resblocks(self, resblocks):
+        """ copy the weights of trained ResBlock1 or ResBlock2, weight norm removed """
+        if isinstance(resblocks[0], ResBlock1):
+            branches = [[(c1, c2) for c1, c2 in zip(r.convs1, r.convs2)] for r in resblocks]
+        else:
+            branches = [[(c,) for c in r.convs] for r in resblocks]
+
+        if not self.grouped:
+            for convs, branch in zip(self.convs, branches):
+                for stage, trained in zip(convs, branch):
+                    for conv, c in zip(stage, trained):
+                        conv.weight.copy_(c.weight)
+                        conv.bias.copy_(c.bias)
+            return
+
+        k = self.convs[0][0].kernel_size[0]
+        for s, stage in enumerate(self.convs):
+            for p, conv in enumerate(stage):
+                trained = [branch[s][p] for branch in branches]
+                # centre the smaller kernels in the largest one
+                pad = [(k - c.kernel_size[0]) // 2 for c in trained]
+                conv.weight.copy_(torch.cat([F.pad(c.weight, (q, q)) for c, q in zip(trained, pad)]))
+                conv.bias.copy_(torch.cat([c.bias for c in trained]))
+
+    def forward(self, x, mask=None):
+        # returns the sum, not the average, of the branches
+        xt = mask_padding(F.leaky_relu(x, LRELU_SLOPE), mask)
+        if self.grouped:
+            n = len(self.dilations)
+            x = x.repeat(1, n, 1)
+            xt = xt.repeat(1, n, 1)
+            for i, stage in enumerate(self.convs):
+                if i > 0:
+                    xt = mask_padding(F.leaky_relu(x, LRELU_SLOPE), mask)
+                for j, conv in enumerate(stage):
+                    if j > 0:
+                        xt = mask_padding(F.leaky_relu(xt, LRELU_SLOPE), mask)
+                    xt = conv(xt)
+                x = xt + x
+            return x.view(x.shape[0], n, self.channels, -1).sum(dim=1)
+
+        xs = None
+        for branch in self.convs:
+            y = x
+            for i, stage in enumerate(branch):
+                yt = xt if i == 0 else mask_padding(F.leaky_relu(y, LRELU_SLOPE), mask)
+                for j, conv in enumerate(stage):
+                    if j > 0:
+                        yt = mask_padding(F.leaky_relu(yt, LRELU_SLOPE), mask)
+                    yt = conv(yt)
+                y = yt + y
+            xs = y if xs is None else xs.add_(y)
+        return xs
+
+    def receptive_field(self):
+        # of the widest branch, without the zero-padding of grouped kernels
+        return max(sum(d * (k - 1) // 2 for stage in dilations for d in stage)
+                   for k, dilations in zip(self.h.resblock_kernel_sizes, self.dilations))
+
+
+class FrozenGenerator(torch.nn.Module):
+    """
+    Inference only Generator built from a trained one with Generator.freeze().
+
+    No weight norm, the 1/num_kernels average of the resblocks is folded into
+    the weights of the next conv (leaky_relu is positively homogeneous) and 
+    the parallel resblocks of a level run as FrozenResBlocks. 
+    Same interface and outputs as Generator.
+    """
+    def __init__(self, h, grouped=None):
+        super(FrozenGenerator, self).__init__()
+        self.h = h
+        self.num_kernels = len(h.resblock_kernel_sizes)
+        self.num_upsamples = len(h.upsample_rates)
+        # grouped resblocks per upsampling level
+        self.grouped = list(grouped) if grouped is not None else [False] * self.num_upsamples
+        self.conv_pre = Conv1d(80, h.upsample_initial_channel, 7, 1, padding=3)
+
+        self.ups = nn.ModuleList()
+        for i, (u, k) in enumerate(zip(h.upsample_rates, h.upsample_kernel_sizes)):
+            self.ups.append(ConvTranspose1d(h.upsample_initial_channel//(2**i), 
+                                            h.upsample_initial_channel//(2**(i+1)),
+                                            k, u, padding=(k-u)//2))
+
+        self.resblocks = nn.ModuleList()
+        for i in range(len(self.ups)):
+            ch = h.upsample_initial_channel//(2**(i+1))
+            self.resblocks.append(FrozenResBlocks(h, ch, grouped=self.grouped[i]))
+
+        self.conv_post = Conv1d(ch, 1, 7, 1, padding=3)
+
+    @torch.no_grad()
+    def load_generator(self, generator):
+        """ copy and fold the weights of a trained Generator, weight norm removed """
+        for frozen, conv in [(self.conv_pre, generator.conv_pre), (self.conv_post, generator.conv_post)] + \
+                            list(zip(self.ups, generator.ups)):
+            frozen.weight.copy_(conv.weight)
+            frozen.bias.copy_(conv.bias)
+        # the resblocks sum is averaged by the conv that follows it
+        for conv in list(self.ups[1:]) + [self.conv_post]:
+            conv.weight.div_(self.num_kernels)
+        for i, resblocks in enumerate(self.resblocks):
+            resblocks.load_resblocks(generator.resblocks[i*self.num_kernels:(i+1)*self.num_kernels])
+
+    def resblocks_forward(self, i, x, mask=None):
+        # the average is folded into the next conv
+        return self.resblocks[i](x, mask)
+
+    def resblocks_receptive_field(self, i):
+        return self.resblocks[i].receptive_field()
+
+    forward = Generator.forward
+    receptive_field = Generator.receptive_field
+    hop_length = Generator.hop_length
+    vocode_chunk = Generator.vocode_chunk
+    stream = Generator.stream
+    silence = Generator.silence
+    vocode_sparse = Generator.vocode_sparse
+    vocode_parallel = Generator.vocode_parallel
+
+
 class DiscriminatorP(torch.nn.Module):
     def __init__(self, period, kernel_size=5, stride=3, use_spectral_norm=False):
         super(DiscriminatorP, self).__init__()
@@ -1,10 +1,8 @@
-
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import math
 
-from utils.tools import pad
+from .networks import length_regulate
 
 #device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -15,69 +13,22 @@ class LengthRegulator(nn.Module):
         super(LengthRegulator, self).__init__()
 
     def LR(self, x, duration, max_len):
-        output = list()
-        mel_len = list()
-
-        for batch, expand_target in zip(x, duration):
-            expanded = self.expand(batch, expand_target)
-            output.append(expanded)
-            mel_len.append(expanded.shape[0])
-
-        if max_len is not None:
-            output = pad(output, max_len)
-        else:
-            output = pad(output)
-        
-        return output, torch.LongTensor(mel_len).to(x.device)
-
-    def expand(self, batch, predicted):
-        out = list()
-
-        for i, vec in enumerate(batch):
-            expand_size = predicted[i].item() if i < predicted.shape[0] else 0
-            expand_size = 1 if math.isnan(expand_size) else expand_size 
-            out.append(vec.expand(max(int(expand_size), 0), -1))
-        out = torch.cat(out, 0)
+        # nan durations expand to 1 frame, missing durations to 0 frames
+        duration = torch.nan_to_num(duration.float(), nan=1.)
+        if duration.shape[1] < x.shape[1]:
+            duration = F.pad(duration, (0, x.shape[1] - duration.shape[1]))
+        duration = duration[:, :x.shape[1]]
+        output, _, mel_len = length_regulate(x, duration, max_len=max_len)
 
-        return out
+        return output, mel_len
 
     def forward(self, x, duration, max_len):
         output, mel_len = self.LR(x, duration, max_len)
         return output, mel_len
 
 
-class LengthRegulatorONNX(nn.Module):
+class LengthRegulatorONNX(LengthRegulator):
     """Length Regulator"""
 
     def __init__(self):
-        super(LengthRegulator, self).__init__()
-
-    def LR(self, x, duration, max_len):
-        output = list()
-        mel_len = list()
-        for batch, expand_target in zip(x, duration):
-            expanded = self.expand(batch, expand_target)
-            output.append(expanded)
-            mel_len.append(expanded.shape[0])
-
-        if max_len is not None:
-            output = pad(output, max_len)
-        else:
-            output = pad(output)
-
-        return output, torch.LongTensor(mel_len).to(x.device)
-
-    def expand(self, batch, predicted):
-        out = list()
-
-        for i, vec in enumerate(batch):
-            expand_size = predicted[i].item() if i < predicted.shape[0] else 0
-            expand_size = 1 if math.isnan(expand_size) else expand_size 
-            out.append(vec.expand(max(int(expand_size), 0), -1))
-        out = torch.cat(out, 0)
-
-        return out
-
-    def forward(self, x, duration, max_len):
-        output, mel_len = self.LR(x, duration, max_len)
-        return output, mel_len
\ No newline at end of file
+        super(LengthRegulatorONNX, self).__init__()
@@ -1,5 +1,5 @@
 
-from einops import reduce, repeat
+from einops import reduce
 from torch import nn
 import torch
 import torch.nn.functional as F
@@ -19,8 +19,11 @@ class MixFFN(nn.Module):
         self.act = nn.GELU()
         
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
         x = self.mlp1(x)
+        # zero padded positions so the conv sees the same input as an unpadded sequence
+        if mask is not None:
+            x = x.masked_fill(mask, 0)
         x = x.permute(0, 2, 1)
         x = self.conv(x)
         x = x.permute(0, 2, 1)
@@ -46,7 +49,6 @@ class SelfAttention(nn.Module):
         # qkv dim is [3, B, num_heads, N, C]
         q, k, v = qkv.unbind(0)   # make torchscript happy (cannot use tensor as tuple)
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
         attn_mask = None
         if mask is not None:
             if pool > 1:
@@ -54,24 +56,150 @@ class SelfAttention(nn.Module):
                 if mod > 0:
                     pad = [0, int(pool-mod)]
                     mask = F.pad(mask, pad, value=True)
-                mask = reduce(mask, 'b (n p) -> b n', 'max', p=pool)
+                # a pooled position is padding only if all its inputs are padding
+                mask = reduce(mask, 'b (n p) -> b n', 'min', p=pool)
 
-            attn_mask = mask.unsqueeze(1).expand(-1, attn.shape[-1], -1)
-            attn_mask = attn_mask.repeat(self.num_heads, 1, 1) 
-            attn_mask = attn_mask.reshape(-1, self.num_heads, attn_mask.shape[-2], attn_mask.shape[-1])
+            # (b, 1, 1, n) key padding mask, True on keys that take part in attention
+            attn_mask = ~mask[:, None, None, :]
 
-        attn = attn.softmax(dim=-1)
-
-        x = (attn @ v).transpose(1, 2).reshape(B, N, -1)
+        x = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, scale=self.scale)
+        x = x.transpose(1, 2).reshape(B, N, -1)
         x = self.proj(x)
         
+        # (b, n, 1) padding mask, broadcasts over channels
         if mask is not None:
-            attn_mask = repeat(mask, 'b n -> b n a', a=x.shape[-1])
+            mask = mask.unsqueeze(-1)
 
-        return x, attn_mask
+        return x, mask
+
+    def forward_eager(self, x):
+        """ reference attention math, unpadded inputs only """
+        B, N, C = x.shape
+        qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv.unbind(0)
+        attn = (q @ k.transpose(-2, -1)) * self.scale
+        attn = attn.softmax(dim=-1)
+        x = (attn @ v).transpose(1, 2).reshape(B, N, -1)
+        return self.proj(x)
+
+
+class PolyphaseConvTranspose1d(nn.Module):
+    """
+    ConvTranspose1d computed as stride 1 convolutions, one per output phase, 
+    that are interleaved. Output phase r of a stride s transposed conv only
+    sees the taps r, r+s, r+2s, ... of the kernel, so all s phases run as one
+    Conv1d with s x out_channels outputs. Inference only, dilation 1 and 
+    groups 1. Use from_conv_transpose to build it from a trained layer.
+    """
+    def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=0, output_padding=0):
+        super().__init__()
+        self.in_channels = in_channels
+        self.out_channels = out_channels
+        # same attributes as nn.ConvTranspose1d
+        self.kernel_size = (kernel_size,)
+        self.stride = (stride,)
+        self.padding = (padding,)
+        self.output_padding = (output_padding,)
+        # taps per phase
+        self.phase_size = -(-kernel_size // stride)
+        assert kernel_size + output_padding - padding <= self.phase_size * stride, \
+            "output_padding is not supported for this kernel size and padding"
+        self.conv = nn.Conv1d(in_channels, stride * out_channels, self.phase_size, 
+                              padding=self.phase_size - 1)
+
+    @classmethod
+    def from_conv_transpose(cls, conv):
+        assert conv.groups == 1 and conv.dilation[0] == 1 and conv.padding_mode == "zeros"
+        polyphase = cls(conv.in_channels, conv.out_channels, conv.kernel_size[0], 
+                        stride=conv.stride[0], padding=conv.padding[0], 
+                        output_padding=conv.output_padding[0])
+        polyphase = polyphase.to(conv.weight)
+        polyphase.load_conv_transpose(conv)
+        return polyphase
+
+    @torch.no_grad()
+    def load_conv_transpose(self, conv):
+        # (in, out, k) -> (stride * out, in, phase_size). weight of phase r, 
+        # tap j is the flipped kernel tap r + (phase_size - 1 - j) * stride
+        stride, size = self.stride[0], self.phase_size
+        weight = F.pad(conv.weight, (0, stride * size - self.kernel_size[0]))
+        weight = weight.reshape(self.in_channels, self.out_channels, size, stride).flip(2)
+        self.conv.weight.copy_(weight.permute(3, 1, 0, 2).reshape(-1, self.in_channels, size))
+        bias = conv.bias if conv.bias is not None else weight.new_zeros(self.out_channels)
+        self.conv.bias.copy_(bias.repeat(stride))
+
+    def forward(self, x):
+        B, _, L = x.shape
+        stride = self.stride[0]
+        # (b, stride, c, n) -> (b, c, n, stride), interleave the phases
+        x = self.conv(x)
+        x = x.view(B, stride, self.out_channels, -1).permute(0, 2, 3, 1).reshape(B, self.out_channels, -1)
+        length = (L - 1) * stride - 2 * self.padding[0] + self.kernel_size[0] + self.output_padding[0]
+        return x[..., self.padding[0]:self.padding[0] + length]
+
+
+def polyphase(module):
+    """ Replace in place every ConvTranspose1d of module with a PolyphaseConvTranspose1d.
+        Weight norm must be removed first. """
+    for name, child in module.named_children():
+        if isinstance(child, nn.ConvTranspose1d):
+            setattr(module, name, PolyphaseConvTranspose1d.from_conv_transpose(child))
+        else:
+            polyphase(child)
+    return module
 
 
 if __name__ == "__main__":
-    x = torch.rand((32, 256, 100))
-    y = SelfAttention(256)(x)
-    print(y.size())
+    import time
+    torch.manual_seed(0)
+    with torch.no_grad():
+        for num_heads in [1, 2]:
+            attn = SelfAttention(64, num_heads=num_heads).eval()
+            # parity with the eager math for unpadded inputs
+            for n in [1, 7, 64, 300]:
+                x = torch.rand((4, n, 64))
+                y, _ = attn(x)
+                print("heads: {}, len: {}, max diff: {:.2e}".format(num_heads, n,
+                      (y - attn.forward_eager(x)).abs().max().item()))
+
+            # padded keys are ignored
+            x = torch.rand((2, 50, 64))
+            mask = torch.arange(50).unsqueeze(0) >= torch.tensor([[50], [30]])
+            y, _ = attn(x, mask=mask)
+            print("heads: {}, padded max diff: {:.2e}".format(num_heads,
+                  (y[1, :30] - attn.forward_eager(x[1:, :30])[0]).abs().max().item()))
+
+        # microbenchmark, fused vs eager
+        attn = SelfAttention(128, num_heads=2).eval()
+        for n in [32, 128, 512, 2048]:
+            x = torch.rand((1, n, 128))
+            for name, fn in [("fused", lambda x: attn(x)[0]), ("eager", attn.forward_eager)]:
+                for _ in range(3):
+                    fn(x)
+                start_time = time.time()
+                for _ in range(20):
+                    fn(x)
+                print("len: {}, {}: {:.3f}ms".format(n, name, (time.time() - start_time) / 20 * 1000))
+
+        # polyphase vs transposed conv, HiFi-GAN LJ_V2 ups and tiny Fuse layers.
+        # without mkldnn, as on cpus where it is not available, eg most arm builds
+        layers = [(128, 64, 16, 8, 4, 128), (64, 32, 16, 8, 4, 1024), (32, 16, 4, 2, 1, 8192),
+                  (16, 8, 4, 2, 1, 16384), (32, 32, 3, 2, 0, 64)]
+        for mkldnn, threads in [(m, t) for m in [True, False] for t in [1, 2, 4]]:
+            torch.set_num_threads(threads)
+            torch.backends.mkldnn.enabled = mkldnn
+            for c_in, c_out, k, stride, padding, n in layers:
+                conv = nn.ConvTranspose1d(c_in, c_out, k, stride, padding=padding).eval()
+                fast = PolyphaseConvTranspose1d.from_conv_transpose(conv)
+                x = torch.rand((1, c_in, n))
+                times = []
+                for fn in [conv, fast]:
+                    for _ in range(3):
+                        fn(x)
+                    start_time = time.time()
+                    for _ in range(20):
+                        fn(x)
+                    times.append((time.time() - start_time) / 20 * 1000)
+                print("mkldnn: {}, threads: {}, {}->{} k{} s{} len {}: transposed {:.3f}ms, polyphase {:.3f}ms, "
+                      "max diff: {:.2e}".format(mkldnn, threads, c_in, c_out, k, stride, n, *times,
+                                                (conv(x) - fast(x)).abs().max().item()))
@@ -51,7 +51,10 @@ class Encoder(nn.Module):
 
     def forward(self, phoneme, mask=None):
         features = []
-        x = self.embed(phoneme) 
+        x = self.embed(phoneme)
+        # zero padded positions before the 1st merge conv, whatever the padding_idx row holds
+        if mask is not None:
+            x = x.masked_fill(mask.unsqueeze(-1), 0)
         # merge, attn and mixffn operates on n or seqlen dim
         # b = batch, n = sequence len, c = channel (1st layer is embedding)
         # (b, n, c)
@@ -67,7 +70,8 @@ class Encoder(nn.Module):
             x = x.permute(0, 2, 1)
             # self-attention with skip connect
             if mask is not None:
-                pool = int(torch.round(torch.tensor([n / x.shape[-2]], requires_grad=False)).item())
+                # from shapes only, no host-device sync
+                pool = round(n / x.shape[-2])
             
             y, attn_mask = attn(x, mask=mask, pool=pool)
             x = norm1(y + x)
@@ -77,7 +81,7 @@ class Encoder(nn.Module):
                     decoder_mask = attn_mask
            
             # Mix-FFN with skip connect
-            x = norm2(mixffn(x) + x)
+            x = norm2(mixffn(x, mask=attn_mask) + x)
             
             if attn_mask is not None:
                 x = x.masked_fill(attn_mask, 0)
@@ -148,11 +152,13 @@ class AcousticDecoder(nn.Module):
             return self.get_energy_embedding(pred, target, mask, control)
         return None
 
-    def forward(self, fused_features):
+    def forward(self, fused_features, mask=None):
         y = fused_features.permute(0, 2, 1)
         y = self.conv1(y)
         y = y.permute(0, 2, 1)
         y = nn.ReLU()(self.norm1(y))        
+        if mask is not None:
+            y = y.masked_fill(mask, 0)
         y = y.permute(0, 2, 1)
         y = self.conv2(y)
         y = y.permute(0, 2, 1)
@@ -165,6 +171,55 @@ class AcousticDecoder(nn.Module):
         return y
 
 
+class FusedAcousticDecoder(nn.Module):
+    """ Pitch, energy and duration predictors sharing one conv1 and norm1, inference only """
+
+    def __init__(self, pitch_decoder, energy_decoder, duration_decoder):
+        super().__init__()
+
+        # not registered as submodules, so the state_dict is unchanged
+        self.decoders = (pitch_decoder, energy_decoder, duration_decoder)
+
+        # conv1 of the 3 decoders see the same input, repack into one (3C, C, k) conv.
+        # buffers are not persistent so checkpoints load as before.
+        self.register_buffer("conv1_weight", torch.cat([d.conv1[0].weight.detach() 
+                                                        for d in self.decoders]), persistent=False)
+        self.register_buffer("conv1_bias", torch.cat([d.conv1[0].bias.detach() 
+                                                      for d in self.decoders]), persistent=False)
+        # (3, C) affine of the 3 norm1
+        self.register_buffer("norm1_weight", torch.stack([d.norm1.weight.detach() 
+                                                          for d in self.decoders]), persistent=False)
+        self.register_buffer("norm1_bias", torch.stack([d.norm1.bias.detach() 
+                                                        for d in self.decoders]), persistent=False)
+        self.norm1_eps = pitch_decoder.norm1.eps
+
+    def forward(self, fused_features, mask=None):
+        """ Returns pitch, energy and duration predictions (B, N, 1) and the
+            duration features (B, N, C), bit-identical to the separate decoders. """
+        B, N, _ = fused_features.shape
+        # static channel size, traced shapes are not accepted by onnx layer_norm
+        C = self.norm1_weight.shape[-1]
+        y = F.conv1d(fused_features.permute(0, 2, 1), self.conv1_weight, self.conv1_bias, 
+                     padding=self.decoders[0].conv1[0].padding)
+        y = F.relu(y).permute(0, 2, 1).reshape(B, N, 3, C)
+        y = F.layer_norm(y, (C,), eps=self.norm1_eps) * self.norm1_weight + self.norm1_bias
+        y = F.relu(y)
+        if mask is not None:
+            y = y.masked_fill(mask.unsqueeze(-1), 0)
+
+        # conv2 stays per decoder, faster on cpu than a grouped conv. same
+        # input layout as in AcousticDecoder so the same conv kernels are used
+        preds = []
+        for i, decoder in enumerate(self.decoders):
+            x = decoder.conv2(y[:, :, i].contiguous().permute(0, 2, 1)).permute(0, 2, 1)
+            preds.append(decoder.linear(x))
+
+        duration_features = self.decoders[2].norm2(x)
+        pitch_pred, energy_pred, duration_pred = preds
+
+        return pitch_pred, energy_pred, F.relu(duration_pred), duration_features
+
+
 class Fuse(nn.Module):
     """ Fuse Attn Features"""
 
@@ -219,41 +274,68 @@ class Fuse(nn.Module):
         return fused_features
 
 
+def length_regulate(features, duration, max_len=None, masks=None, pad_value=None):
+    """ Expand phoneme-rate features to frame rate for the whole batch at once.
+
+    Each frame is mapped to the phoneme that covers it using the cumulative
+    durations, then gathered. Equivalent to a per-utterance repeat_interleave
+    followed by padding to max_len (or to the longest utterance).
+
+    Args:
+        features: (B, N, C) phoneme-rate features
+        duration: (B, N) number of frames per phoneme
+        max_len: frame length of the output. Longer utterances are truncated.
+        masks: optional (B, N, 1) bool masks, expanded the same way
+        pad_value: optional (1, 1, C) value of the padded frames. Default is 0.
+
+    Returns:
+        features (B, T, C), masks (B, T, 1) True on padded frames, mel_len (B,)
+    """
+    if duration.dim() == 3:
+        duration = duration.squeeze(-1)
+    duration = duration.long().clamp(min=0)
+    cum_duration = torch.cumsum(duration, dim=1)
+    mel_len = cum_duration[:, -1]
+    if max_len is None:
+        # keep as tensor so that the frame axis stays dynamic when traced
+        max_len = mel_len.max()
+
+    # frame to phoneme index, (B, T)
+    frames = torch.arange(max_len, device=features.device)
+    frames = frames.unsqueeze(0).expand(features.shape[0], -1).contiguous()
+    if torch.onnx.is_in_onnx_export():
+        # searchsorted has no onnx op, count the phonemes that ended before each frame
+        index = (cum_duration.unsqueeze(1) <= frames.unsqueeze(-1)).sum(dim=-1)
+    else:
+        index = torch.searchsorted(cum_duration, frames, right=True)
+    index = index.clamp(max=features.shape[1] - 1)
+    pad_mask = (frames >= mel_len.unsqueeze(1)).unsqueeze(-1)
+
+    index = index.unsqueeze(-1)
+    features = torch.gather(features, 1, index.expand(-1, -1, features.shape[-1]))
+    if pad_value is None:
+        features = features.masked_fill(pad_mask, 0.0)
+    else:
+        features = torch.where(pad_mask, pad_value, features)
+    if masks is not None:
+        pad_mask = torch.gather(masks, 1, index) | pad_mask
+
+    return features, pad_mask, mel_len
+
+
 class FeatureUpsampler(nn.Module):
     """ Upsample fused features using target or predicted duration"""
 
     def __init__(self):
         super().__init__()
 
-    def forward(self, fused_features, fused_masks, duration, max_mel_len=None):
-        mel_len = list()
-        features = list()
-        masks = list()
-
-        for feature, mask, repetition in zip(fused_features, fused_masks, duration):
-            repetition = repetition.squeeze().int()
-            feature = feature.repeat_interleave(repetition, dim=0)
-            mask = mask.repeat_interleave(repetition, dim=0)
-            mel_len.append(feature.shape[0])
-            if max_mel_len is not None:
-                feature = F.pad(feature, (0, 0, 0, max_mel_len -
-                                feature.shape[0]), "constant", 0.0)
-                mask = F.pad(mask, (0, 0, 0,  max_mel_len -
-                             mask.shape[0]), "constant", True)
-            features.append(feature)
-            masks.append(mask)
-
-        if max_mel_len is None:
-            max_mel_len = max(mel_len)
-            features = [F.pad(feature, (0, 0, 0, max_mel_len - feature.shape[0]),
-                              "constant", 0.0) for feature in features]
-            masks = [F.pad(mask, (0, 0, 0, max_mel_len - mask.shape[0]),
-                           "constant", True) for mask in masks]
-
-        features = torch.stack(features)
-        masks = torch.stack(masks)
-        len_pred = torch.IntTensor(mel_len).to(features.device)
-        #len_pred = torch.LongTensor(mel_len).to(features.device)
+    def forward(self, fused_features, fused_masks, duration, max_mel_len=None, pad_value=None):
+        features, masks, mel_len = length_regulate(fused_features,
+                                                   duration,
+                                                   max_len=max_mel_len,
+                                                   masks=fused_masks,
+                                                   pad_value=pad_value)
+        len_pred = mel_len.int()
 
         return features, masks, len_pred
 
@@ -288,11 +370,15 @@ class MelDecoder(nn.Module):
         self.mel_linear = nn.Linear(dim_x2, self.n_mel_channels)
 
 
-    def forward(self, features):
-        skip = self.proj(features)
+    def forward(self, features, projected=False, mask=None):
+        # projected=True if self.proj was already applied at phoneme rate
+        # mask: (b, n, 1) True on padded frames, zeroed before each conv
+        skip = features if projected else self.proj(features)
         for convs, skip_norm in self.blocks:
             x = skip
             for conv, norm in convs:
+                if mask is not None:
+                    x = x.masked_fill(mask, 0)
                 x = conv(x.permute(0, 2, 1))
                 x = norm(x.permute(0, 2, 1))
 
@@ -303,6 +389,151 @@ class MelDecoder(nn.Module):
 
         return mel
 
+    def receptive_field(self):
+        """ one-sided context in frames of a decoded mel frame """
+        return sum(conv[0].padding[-1] for convs, _ in self.blocks for conv, _ in convs)
+
+    def stream(self, features, projected=False, chunk_size=32):
+        """
+        Decode frame features incrementally, batch size 1 and no padding.
+
+        Each depthwise conv caches its last 2 x padding input frames as left
+        context and only emits the frames whose right context has arrived,
+        so no frame is decoded twice and the concatenated output equals
+        self(features, projected). Output lags input by receptive_field() frames.
+
+        Args:
+            features: (B, T, C) frame features or an iterable of (B, t, C) chunks
+            projected: True if self.proj was already applied
+            chunk_size: frames per input chunk when features is a tensor
+
+        Yields:
+            (B, t, n_mel_channels) mel chunks
+        """
+        if torch.is_tensor(features):
+            features = features.split(chunk_size, dim=1)
+
+        # per conv: cached input (B, n, C) starting at the next output frame - padding
+        caches = [[None for _ in convs] for convs, _ in self.blocks]
+        # per block: block input frames waiting for the delayed conv output
+        skips = [None for _ in self.blocks]
+
+        def conv_step(conv, cache, x, last):
+            # x: (B, t, C) new input frames, returns new output frames and cache
+            padding = conv[0].padding[-1]
+            if cache is None:
+                cache = x.new_zeros(x.shape[0], padding, x.shape[2])
+            cache = torch.cat([cache, x], dim=1)
+            if last:
+                cache = F.pad(cache, (0, 0, 0, padding))
+            n = cache.shape[1] - 2 * padding
+            if n <= 0:
+                return x[:, :0], cache
+            return self.stream_conv(conv, cache), cache[:, n:]
+
+        def step(x, last=False):
+            skip = x if projected else self.proj(x)
+            for i, (convs, skip_norm) in enumerate(self.blocks):
+                skips[i] = skip if skips[i] is None else torch.cat([skips[i], skip], dim=1)
+                x = skip
+                for j, (conv, norm) in enumerate(convs):
+                    x, caches[i][j] = conv_step(conv, caches[i][j], x, last)
+                    x = norm(x)
+                n = x.shape[1]
+                skip = skip_norm(x + skips[i][:, :n])
+                skips[i] = skips[i][:, n:]
+            return self.mel_linear(skip)
+
+        x = None
+        for x in features:
+            mel = step(x)
+            if mel.shape[1] > 0:
+                yield mel
+
+        if x is None:
+            return
+        # end of utterance, flush with right zero padding
+        mel = step(x[:, :0], last=True)
+        if mel.shape[1] > 0:
+            yield mel
+
+    def stream_conv(self, conv, x):
+        """ conv without padding on (B, n, C) frames, returns (B, n - 2 x padding, C) """
+        y = F.conv1d(x.permute(0, 2, 1), conv[0].weight, conv[0].bias, groups=conv[0].groups)
+        return conv[2](conv[1](y)).permute(0, 2, 1)
+
+
+def mel_decoder_to_channels_last(state_dict):
+    """ Convert a MelDecoder state_dict to ChannelsLastMelDecoder.
+        Conv1d weights (O, I, k) become (1, k) Conv2d weights (O, I, 1, k). """
+    return {k: v.unsqueeze(2) if k.endswith("weight") and v.dim() == 3 else v 
+            for k, v in state_dict.items()}
+
+
+class ChannelsLastMelDecoder(MelDecoder):
+    """ MelDecoder for inference that keeps features in (B, N, C) memory order
+
+    Convs are (1, k) Conv2d on channels_last tensors, ie (B, N, C) memory viewed
+    as (B, C, 1, N), so the convs and the LayerNorms over C run on the same 
+    memory without the contiguous copies of the Conv1d permutes.
+    The layers are MelDecoder's with each Conv1d swapped for the same Conv2d.
+    Use from_decoder to build it from a trained MelDecoder.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        for module in list(self.modules()):
+            for name, conv in module.named_children():
+                if isinstance(conv, nn.Conv1d):
+                    conv2d = nn.Conv2d(conv.in_channels, conv.out_channels, groups=conv.groups,
+                                       kernel_size=(1, conv.kernel_size[0]), stride=(1, conv.stride[0]),
+                                       padding=(0, conv.padding[0]), bias=conv.bias is not None)
+                    conv2d.load_state_dict(mel_decoder_to_channels_last(conv.state_dict()))
+                    setattr(module, name, conv2d)
+        self.to(memory_format=torch.channels_last)
+
+    @classmethod
+    def from_decoder(cls, decoder):
+        depthwise = decoder.blocks[0][0][0][0][0]
+        channels_last = cls(decoder.proj[0].in_features // 4,
+                            kernel_size=depthwise.kernel_size[0],
+                            n_mel_channels=decoder.n_mel_channels,
+                            n_blocks=len(decoder.blocks),
+                            block_depth=len(decoder.blocks[0][0]))
+        channels_last.load_state_dict(mel_decoder_to_channels_last(decoder.state_dict()))
+        return channels_last.to(depthwise.weight.device, depthwise.weight.dtype, 
+                                memory_format=torch.channels_last)
+
+    def forward(self, features, projected=False, mask=None):
+        # same as MelDecoder.forward. x is (b, c, 1, n) in channels_last so
+        # x.permute(0, 2, 3, 1) is a contiguous (b, 1, n, c) for the LayerNorms
+        skip = features if projected else self.proj(features)
+        skip = skip.unsqueeze(1).permute(0, 3, 1, 2)
+        if mask is not None:
+            # (b, n, 1) -> (b, 1, 1, n)
+            mask = mask.permute(0, 2, 1).unsqueeze(2)
+
+        for convs, skip_norm in self.blocks:
+            x = skip
+            for conv, norm in convs:
+                if mask is not None:
+                    x = x.masked_fill(mask, 0)
+                x = conv(x)
+                x = norm(x.permute(0, 2, 3, 1)).permute(0, 3, 1, 2)
+
+            skip = skip_norm((x + skip).permute(0, 2, 3, 1)).permute(0, 3, 1, 2)
+
+        # resize channel to mel length (eg 80)
+        mel = self.mel_linear(skip.permute(0, 2, 3, 1).squeeze(1))
+
+        return mel
+
+    def stream_conv(self, conv, x):
+        # (B, n, C) memory viewed as channels_last (B, C, 1, n) and back
+        y = F.conv2d(x.unsqueeze(1).permute(0, 3, 1, 2), conv[0].weight, conv[0].bias, groups=conv[0].groups)
+        return conv[2](conv[1](y)).permute(0, 2, 3, 1).squeeze(1)
+
 
 class PhonemeEncoder(nn.Module):
     """ Encodes phonemes to acoustic features """
@@ -315,9 +546,15 @@ class PhonemeEncoder(nn.Module):
                  head=1, 
                  embed_dim=128, 
                  kernel_size=3, 
-                 expansion=1):
+                 expansion=1,
+                 window=1024,
+                 overlap=64):
         super().__init__()
 
+        # inference of sequences longer than window phonemes is done in windows
+        # that overlap by overlap phonemes on each side. None to disable.
+        self.window = window
+        self.overlap = overlap
         self.encoder = Encoder(depth=depth,
                                reduction=reduction, 
                                head=head, 
@@ -331,64 +568,116 @@ class PhonemeEncoder(nn.Module):
         self.pitch_decoder = AcousticDecoder(dim, pitch_stats=pitch_stats)
         self.energy_decoder = AcousticDecoder(dim, energy_stats=energy_stats)
         self.duration_decoder = AcousticDecoder(dim, duration=True)
+        # set by fuse_decoders() for inference
+        self.fused_decoder = None
+
+    def fuse_decoders(self):
+        """ Run the pitch, energy and duration decoders as one FusedAcousticDecoder
+            during inference. Call after the weights are loaded. """
+        self.fused_decoder = FusedAcousticDecoder(self.pitch_decoder,
+                                                  self.energy_decoder,
+                                                  self.duration_decoder)
         
 
-    def forward(self, x, train=False):
-        phoneme = x["phoneme"]
-        phoneme_mask = x["phoneme_mask"] if phoneme.shape[0] > 1 else None
-
-        pitch_target = x["pitch"] if train else None
-        energy_target = x["energy"] if train  else None
-        duration_target = x["duration"] if train  else None
-        mel_len = x["mel_len"] if train  else None
-        max_mel_len = torch.max(mel_len).item() if train else None
-
+    def encode(self, phoneme, phoneme_mask=None, pitch_target=None, energy_target=None):
+        """ Phoneme rate part of forward. Returns fused features (B, N, 4C),
+            pitch, energy and duration predictions and the encoder mask. """
         features, mask = self.encoder(phoneme, mask=phoneme_mask)
         fused_features = self.fuse(features, mask=mask)
         
-        pitch_pred = self.pitch_decoder(fused_features)
+        if self.fused_decoder is not None and not self.training:
+            pitch_pred, energy_pred, duration_pred, duration_features = \
+                self.fused_decoder(fused_features, mask=mask)
+        else:
+            pitch_pred = self.pitch_decoder(fused_features, mask=mask)
+            energy_pred = self.energy_decoder(fused_features, mask=mask)
+            duration_pred, duration_features = self.duration_decoder(fused_features, mask=mask)
+
         pitch_features = self.pitch_decoder.get_embedding(pitch_pred, pitch_target, mask)
-        pitch_features = pitch_features.squeeze()
+        if pitch_features.dim() == 4:
+            pitch_features = pitch_features.squeeze(2)
         if mask is not None:
             pitch_features = pitch_features.masked_fill(mask, 0)
-        elif pitch_features.dim() != 3:
-            pitch_features = pitch_features.unsqueeze(0)
 
-        energy_pred = self.energy_decoder(fused_features)
         energy_features = self.energy_decoder.get_embedding(energy_pred, energy_target, mask)
-        energy_features = energy_features.squeeze()
-
+        if energy_features.dim() == 4:
+            energy_features = energy_features.squeeze(2)
         if mask is not None:
             energy_features = energy_features.masked_fill(mask, 0)
-        elif energy_features.dim() != 3:
-            energy_features = energy_features.unsqueeze(0)
 
-        duration_pred, duration_features = self.duration_decoder(fused_features)
         if mask is not None:
             duration_features = duration_features.masked_fill(mask, 0)
-       
+
         fused_features = torch.cat([fused_features, pitch_features, \
                                     energy_features, duration_features], dim=-1)
 
-        # TODO: Use fused_masks of all False for inference of bs=1
-        if mask is None:
-            fused_masks = torch.zeros_like(fused_features).bool()
+        return fused_features, pitch_pred, energy_pred, duration_pred, mask
+
+    def encode_windowed(self, phoneme):
+        """
+        Same as encode for a long unpadded sequence but with attention local to
+        windows of self.window phonemes, so peak memory does not grow with the
+        sequence length. Windows overlap by self.overlap phonemes on each side
+        and only their centres are kept.
+        """
+        n = phoneme.shape[1]
+        step = self.window - 2 * self.overlap
+        # windows must start on the grid of the strided encoder blocks
+        align = 2 ** (len(self.encoder.get_feature_dims()) - 1)
+        assert step > 0 and step % align == 0 and self.overlap % align == 0, \
+            "window - 2*overlap and overlap must be multiples of {}".format(align)
+
+        outputs = []
+        for start in range(0, n, step):
+            lo = max(start - self.overlap, 0)
+            hi = min(start + step + self.overlap, n)
+            end = min(start + step, n)
+            y = self.encode(phoneme[:, lo:hi])[:4]
+            outputs.append([t[:, start - lo:end - lo] for t in y])
+
+        return [torch.cat(t, dim=1) for t in zip(*outputs)]
+
+    def forward(self, x, train=False, proj=None):
+        phoneme = x["phoneme"]
+        phoneme_mask = x.get("phoneme_mask", None)
+
+        pitch_target = x["pitch"] if train else None
+        energy_target = x["energy"] if train  else None
+        duration_target = x["duration"] if train  else None
+        # target mel length is a static shape during training. for inference, an 
+        # optional static frame length avoids the data-dependent frame count
+        max_mel_len = x["mel_mask"].shape[-1] if train else x.get("max_mel_len", None)
+
+        if not train and phoneme_mask is None and self.window is not None \
+                and phoneme.shape[1] > self.window and not torch.onnx.is_in_onnx_export():
+            fused_features, pitch_pred, energy_pred, duration_pred = self.encode_windowed(phoneme)
+            mask = None
         else:
-            fused_masks = torch.cat([mask, mask, mask, mask], dim=-1)
-        
+            fused_features, pitch_pred, energy_pred, duration_pred, mask = \
+                self.encode(phoneme, phoneme_mask, pitch_target, energy_target)
+
+        # proj is position-wise (eg MelDecoder.proj) so it can run at phoneme rate,
+        # before duration expansion. padded frames are set to proj(0) as if
+        # zero-padded features were projected at frame rate.
+        pad_value = None
+        if proj is not None:
+            pad_value = proj(fused_features.new_zeros(1, 1, fused_features.shape[-1]))
+            fused_features = proj(fused_features)
+
         if duration_target is None:
-            duration_target = torch.round(duration_pred).squeeze()
+            duration_target = torch.round(duration_pred).squeeze(-1)
         if phoneme_mask is not None:
             duration_target = duration_target.masked_fill(phoneme_mask, 0).clamp(min=0)
-        else:
-            duration_target = duration_target.unsqueeze(0)
 
+        # (b, n, 1) mask broadcasts over the fused channels
         features, masks, mel_len_pred = self.feature_upsampler(fused_features,
-                                                               fused_masks,
+                                                               mask,
                                                                duration=duration_target,
-                                                               max_mel_len=max_mel_len,)
+                                                               max_mel_len=max_mel_len,
+                                                               pad_value=pad_value,)
     
-        if mask is None:
+        # frame mask is needed if frames were padded up to max_mel_len
+        if mask is None and max_mel_len is None:
             masks = None
 
         y = {"pitch": pitch_pred,
@@ -406,30 +695,93 @@ class Phoneme2Mel(nn.Module):
 
     def __init__(self,
                  encoder,
-                 decoder):
+                 decoder,
+                 early_proj=True):
         super().__init__()
 
         self.encoder = encoder
         self.decoder = decoder
+        # inference only: apply decoder.proj before duration expansion
+        self.early_proj = early_proj
 
-    def forward(self, x, train=False):
+    def forward(self, x, train=False, return_pred=False):
+        # return_pred: inference returns the dict of predictions as in training
         # Dirty trick to enable ONNX compilation.
         # Else, the torch.to_onnx complains about missing input in the forward method.
         if isinstance(x, list):
             x = x[0]
             
-        pred = self.encoder(x, train=train)
-        mel = self.decoder(pred["features"]) 
-        
+        if not train and self.early_proj:
+            # run the decoder input projection at phoneme rate
+            pred = self.encoder(x, proj=self.decoder.proj)
+        else:
+            pred = self.encoder(x, train=train)
+
         mask = pred["masks"]
-        if mask is not None and mel.size(0) > 1:
-            mask = mask[:, :, :mel.shape[-1]]
+        mel = self.decoder(pred["features"], projected=not train and self.early_proj, mask=mask)
+
+        if mask is not None:
             mel = mel.masked_fill(mask, 0)
         
         pred["mel"] = mel
 
-        if train: 
+        if train or return_pred: 
             return pred
 
         return mel, pred["mel_len"], pred["duration"]
 
+    def channels_last(self):
+        """ Inference only: replace the mel decoder with a ChannelsLastMelDecoder
+            converted from the loaded weights. """
+        self.decoder = ChannelsLastMelDecoder.from_decoder(self.decoder)
+        return self
+
+    def stream(self, x, chunk_size=32):
+        """
+        Inference only, batch size 1. The encoder and duration expansion run
+        once, then the mel decoder runs incrementally over chunk_size frames.
+
+        Yields:
+            (1, t, n_mel_channels) mel chunks, concatenated equal to self(x)[0]
+        """
+        if self.early_proj:
+            pred = self.encoder(x, proj=self.decoder.proj)
+        else:
+            pred = self.encoder(x)
+
+        features = pred["features"][:, :int(pred["mel_len"][0])]
+        yield from self.decoder.stream(features, projected=self.early_proj, chunk_size=chunk_size)
+
+
+if __name__ == "__main__":
+    # python3 -m layers.networks
+    # no graph breaks in the training forward and in padded inference with a static frame length
+    import torch._dynamo
+
+    torch.manual_seed(0)
+    encoder = PhonemeEncoder(pitch_stats=(-2., 10.), energy_stats=(-1., 8.))
+    decoder = MelDecoder(dim=128 // 4, kernel_size=3)
+    phoneme2mel = Phoneme2Mel(encoder=encoder, decoder=decoder)
+
+    lengths = torch.tensor([23, 17, 9])
+    phoneme_mask = torch.arange(23).unsqueeze(0) >= lengths.unsqueeze(1)
+    phoneme = torch.randint(1, len(symbols), (3, 23)).masked_fill(phoneme_mask, 0)
+    duration = torch.randint(0, 8, (3, 23)).masked_fill(phoneme_mask, 0)
+    mel_len = duration.sum(1)
+    x = {"phoneme": phoneme,
+         "phoneme_mask": phoneme_mask,
+         "pitch": torch.randn(3, 23),
+         "energy": torch.randn(3, 23),
+         "duration": duration,
+         "mel_mask": torch.arange(int(mel_len.max())).unsqueeze(0) >= mel_len.unsqueeze(1)}
+
+    explanation = torch._dynamo.explain(lambda x: phoneme2mel(x, train=True))(x)
+    print("train graph breaks: {}".format(explanation.graph_break_count))
+    assert explanation.graph_break_count == 0, explanation.break_reasons
+
+    phoneme2mel.eval()
+    with torch.no_grad():
+        x = {"phoneme": phoneme, "phoneme_mask": phoneme_mask, "max_mel_len": 256}
+        explanation = torch._dynamo.explain(lambda x: phoneme2mel(x))(x)
+    print("inference graph breaks: {}".format(explanation.graph_break_count))
+    assert explanation.graph_break_count == 0, explanation.break_reasons
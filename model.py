@@ -14,9 +14,11 @@ import torch.nn as nn
 import math
 
 from layers import PhonemeEncoder, MelDecoder, Phoneme2Mel
+from text.symbols import symbols
 from lightning import LightningModule
 from torch.optim import AdamW
-from utils.tools import write_to_file
+from torch.nn.utils.rnn import pad_sequence
+from utils.tools import write_to_file, get_mask_from_lengths, vocode_batches
 from torch.optim.lr_scheduler import CosineAnnealingLR, LambdaLR
 
 
@@ -32,16 +34,23 @@ def get_hifigan(checkpoint="hifigan/LJ_V2/generator_v2", infer_device=None, verb
 
     config = hifigan.AttrDict(config)
     torch.manual_seed(config.seed)
-    vocoder = hifigan.Generator(config)
     if infer_device is not None:
-        vocoder.to(infer_device)
         ckpt = torch.load(checkpoint, map_location=torch.device(infer_device))
     else:
         ckpt = torch.load(checkpoint)
         #ckpt = torch.load("hifigan/generator_LJSpeech.pth.tar")
-    vocoder.load_state_dict(ckpt["generator"])
+
+    if "grouped" in ckpt:
+        # FrozenGenerator saved by convert.py --hifigan-frozen
+        vocoder = hifigan.FrozenGenerator(config, grouped=ckpt["grouped"])
+        vocoder.load_state_dict(ckpt["generator"])
+    else:
+        vocoder = hifigan.Generator(config)
+        vocoder.load_state_dict(ckpt["generator"])
+        vocoder.remove_weight_norm()
+    if infer_device is not None:
+        vocoder.to(infer_device)
     vocoder.eval()
-    vocoder.remove_weight_norm()
     for p in vocoder.parameters():
         p.requires_grad = False
     
@@ -149,6 +158,11 @@ class EfficientSpeech(LightningModule):
         self.hifigan = get_hifigan(checkpoint=hifigan_checkpoint,
                                    infer_device=infer_device, verbose=verbose)
 
+        # inference: vocode unpadded mels in chunks on vocoder_workers threads
+        # of vocoder_threads intra-op threads each, see Generator.vocode_parallel
+        self.vocoder_workers = None
+        self.vocoder_threads = 1
+
         self.training_step_outputs = []
 
 
@@ -158,12 +172,79 @@ class EfficientSpeech(LightningModule):
 
     def predict_step(self, batch, batch_idx=0,  dataloader_idx=0):
         mel, mel_len, duration = self.phoneme2mel(batch, train=False)
+        mask = None
+        if mel.shape[0] > 1:
+            mask = get_mask_from_lengths(mel_len, mel.shape[1]).unsqueeze(1)
         mel = mel.transpose(1, 2)
-        wav = self.hifigan(mel).squeeze(1)
+        if self.vocoder_workers is not None and mask is None:
+            wav = self.hifigan.vocode_parallel(mel, workers=self.vocoder_workers,
+                                               threads=self.vocoder_threads).squeeze(1)
+        else:
+            wav = self.hifigan(mel, mask=mask).squeeze(1)
         
         return wav, mel_len, duration
 
 
+    def predict_stream(self, batch, chunk_size=32):
+        """
+        Same as predict_step for batch size 1 but yields the wav in chunks of
+        chunk_size mel frames as soon as each chunk is vocoded. The mel
+        decoder runs incrementally so the 1st chunk does not wait for the
+        whole utterance to be decoded.
+        """
+        mels = (mel.transpose(1, 2) for mel in self.phoneme2mel.stream(batch, chunk_size=chunk_size))
+        for wav in self.hifigan.stream(mels, chunk_size=chunk_size):
+            yield wav.squeeze(1)
+
+
+    def predict_sparse(self, batch, energy_threshold=None, min_silence=None, crossfade=2):
+        """
+        Same as predict_step for batch size 1 but long silent spans are not
+        vocoded, see Generator.vocode_sparse. The frames of {sp}, {spn} and
+        {sil} are silent and with energy_threshold, also the frames of
+        phonemes with a lower predicted (normalized) energy.
+        """
+        phoneme = batch["phoneme"]
+        assert phoneme.shape[0] == 1, "batch size must be 1"
+        pred = self.phoneme2mel(batch, train=False, return_pred=True)
+        mel, mel_len, duration = pred["mel"], pred["mel_len"], pred["duration"]
+
+        silences = phoneme.new_tensor([symbols.index(s) for s in ["@sp", "@spn", "@sil"]])
+        silent = torch.isin(phoneme[0], silences)
+        if energy_threshold is not None:
+            silent |= pred["energy"][0].reshape(-1) < energy_threshold
+        # same rounding as the duration expansion of the encoder
+        frames = torch.round(duration[0]).reshape(-1).long()
+        silent = silent.repeat_interleave(frames)[:mel.shape[1]]
+
+        wav = self.hifigan.vocode_sparse(mel.transpose(1, 2), silent, 
+                                         min_silence=min_silence, crossfade=crossfade)
+        return wav.squeeze(1), mel_len, duration
+
+
+    def synthesize_batch(self, phonemes):
+        """
+        Synthesize a batch of phoneme sequences of different lengths.
+
+        Args:
+            phonemes: list of N 1D phoneme id sequences (list, np.ndarray or tensor)
+
+        Returns:
+            list of N 1D waveforms, each trimmed to its predicted length
+        """
+        phonemes = [torch.as_tensor(p, dtype=torch.long) for p in phonemes]
+        phoneme_len = torch.tensor([len(p) for p in phonemes], device=self.device)
+        phoneme = pad_sequence(phonemes, batch_first=True).to(self.device)
+        phoneme_mask = get_mask_from_lengths(phoneme_len, phoneme.shape[1])
+
+        with torch.no_grad():
+            mel, mel_len, _ = self.phoneme2mel({"phoneme": phoneme, "phoneme_mask": phoneme_mask})
+
+        # length-sorted micro-batches, little vocoder compute is spent on padding
+        wavs, _ = vocode_batches(mel.transpose(1, 2), mel_len.tolist(), self.hifigan)
+        return wavs
+
+
     def loss(self, y_hat, y, x):
         pitch_pred = y_hat["pitch"]
         energy_pred = y_hat["energy"]
@@ -256,9 +337,8 @@ class EfficientSpeech(LightningModule):
             mel = y["mel"]
             mel = mel.transpose(1, 2)
             lengths = x["mel_len"]
-            with torch.no_grad():
-                wavs = self.hifigan(mel).squeeze(1)
-                wavs = wavs.to(torch.float).cpu().numpy()
+            wavs, _ = vocode_batches(mel, lengths.tolist(), self.hifigan)
+            wavs = [wav.to(torch.float).cpu().numpy() for wav in wavs]
             
             write_to_file(wavs, self.hparams.preprocess_config, lengths=lengths.cpu().numpy(),\
                     wav_path=self.hparams.wav_path, filename="reconstruction")
@@ -11,35 +11,50 @@ import numpy as np
 import torch
 import time
 
+from itertools import chain
 from string import punctuation
-from g2p_en import G2p
-from text import text_to_sequence
+from text import text_to_sequence, sequence_to_text
+from text.g2p import CachedG2p, LazyG2p, g2p_batch
+from text.lexicon import CompiledLexicon, read_text_lexicon, phones_to_ids, phone_to_id
 from utils.tools import get_mask_from_lengths, synth_one_sample
 
+# word delimiters of text2phoneme, kept as words
+_word_re = re.compile(r"([,;.\-\?\!\s+])")
+
+
 def read_lexicon(lex_path):
-    lexicon = {}
-    with open(lex_path) as f:
-        for line in f:
-            temp = re.split(r"\s+", line.strip("\n"))
-            word = temp[0]
-            phones = temp[1:]
-            if word.lower() not in lexicon:
-                lexicon[word.lower()] = phones
-    return lexicon
-
-
-def get_lexicon_and_g2p(preprocess_config):
+    # a .bin lexicon is compiled with python3 -m text.lexicon and loaded with mmap
+    if lex_path.endswith(".bin"):
+        return CompiledLexicon(lex_path)
+    return read_text_lexicon(lex_path)
+
+
+def get_lexicon_and_g2p(preprocess_config, g2p_cache=None, g2p_data=None, verbose=False):
+    # g2p_cache: optional json file to keep the G2P phones of OOV words across restarts
+    # g2p_data: optional local NLTK data directory, so that G2P downloads nothing
+    # G2P is loaded on the 1st OOV word, never for t1 or text covered by the lexicon
+    start_time = time.time()
     lexicon = read_lexicon(preprocess_config["path"]["lexicon_path"])
-    g2p = G2p()
+    if verbose:
+        print("Lexicon load time: {:.4f}s".format(time.time() - start_time))
+    g2p = CachedG2p(LazyG2p(data_path=g2p_data, verbose=verbose), path=g2p_cache)
     return lexicon, g2p
 
 
+def oov_words(lexicon, text, preprocess_config):
+    """ distinct words of text that text2phoneme converts with G2P """
+    if preprocess_config["preprocessing"]["text"]["language"] == "t1":
+        return []
+    words = dict.fromkeys(_word_re.split(text.rstrip(punctuation)))
+    return [w for w in words if w.lower() not in lexicon]
+
+
 def text2phoneme(lexicon, g2p, text, preprocess_config, verbose=False):
     text = text.rstrip(punctuation)
 
     lang = preprocess_config["preprocessing"]["text"]["language"]
     phones = []
-    words = re.split(r"([,;.\-\?\!\s+])", text)
+    words = _word_re.split(text)
     for w in words:
         if w.lower() in lexicon:
             phones += lexicon[w.lower()]
@@ -63,13 +78,159 @@ def text2phoneme(lexicon, g2p, text, preprocess_config, verbose=False):
 
     return sequence
 
+def words2sequence(lexicon, g2p, words, lang):
+    """
+    Phoneme IDs that text2phoneme gives to distinct words, end to end, the
+    number of IDs of each word and the number of phones, which can be more 
+    than the IDs. Each word is looked up once, the out of vocabulary words 
+    go through G2P in one batch and the phones of all the words are mapped 
+    to IDs in one pass. None if a phone has braces.
+    """
+    compiled = isinstance(lexicon, CompiledLexicon)
+    # per word: IDs of the compiled lexicon, or None if mapped from phones
+    sequences = []
+    # per word mapped from phones: the phones, or None until converted by G2P
+    phones = []
+    oov = []
+    for w in words:
+        key = w.lower()
+        if compiled:
+            ids = lexicon.ids(key)
+            if ids is not None and len(ids) > 0:
+                sequences.append(ids)
+                continue
+            p = None if ids is None else lexicon[key]
+        else:
+            p = lexicon.get(key)
+        if p is None and lang == "t1":
+            p = list(key)
+        elif p is None:
+            oov.append(w)
+        sequences.append(None)
+        phones.append(p)
+
+    g2p_phones = iter(g2p_batch(g2p, oov))
+    phones = [[x for x in next(g2p_phones) if x != " "] if p is None else p for p in phones]
+    lengths = np.fromiter(map(len, phones), dtype=np.intp, count=len(phones))
+    phones = list(chain.from_iterable(phones))
+    n_phones = len(phones) + sum(len(x) for x in sequences if x is not None)
+
+    joined = "".join(phones)
+    if "{" in joined or "}" in joined:
+        return None
+    ids = phones_to_ids(phones)
+    keep = ids >= 0
+    if not keep.all():
+        # IDs left per word once the dropped phones are removed
+        lengths = np.bincount(np.repeat(np.arange(len(lengths)), lengths)[keep], minlength=len(lengths))
+        ids = ids[keep]
+    if len(lengths) < len(sequences):
+        split = iter(np.split(ids, np.cumsum(lengths)[:-1]))
+        sequences = [next(split) if x is None else x for x in sequences]
+        lengths = np.fromiter(map(len, sequences), dtype=np.intp, count=len(sequences))
+        ids = np.concatenate(sequences)
+    return ids, lengths, n_phones
+
+
+def text2sequence(lexicon, g2p, text, preprocess_config, verbose=False):
+    """
+    Same phoneme IDs as text2phoneme, but lexicon and G2P phones are mapped 
+    straight to IDs instead of going through a "{AH0}{B}..." string and 
+    text_to_sequence. Each distinct word, including the delimiters between 
+    words, is looked up or converted by G2P only once, and the IDs of all the
+    words are gathered from the table of distinct words with numpy.
+
+    Returns:
+        1D int32 np.ndarray of phoneme IDs
+    """
+    text = text.rstrip(punctuation)
+
+    lang = preprocess_config["preprocessing"]["text"]["language"]
+    words = _word_re.split(text)
+    # distinct words in order and the index of each word among them
+    distinct = list(dict.fromkeys(words))
+    index = dict(zip(distinct, range(len(distinct))))
+    word_index = np.fromiter(map(index.__getitem__, words), dtype=np.intp, count=len(words))
+
+    table = words2sequence(lexicon, g2p, distinct, lang)
+    if table is None:
+        # braces would end the ARPAbet span of text_to_sequence
+        return text2phoneme(lexicon, g2p, text, preprocess_config, verbose=verbose).astype(np.int32)
+
+    ids, lengths, n_phones = table
+    if n_phones == 0:
+        # "{}" becomes "{sp}" in text2phoneme
+        sequence = np.array([phone_to_id("sp")], dtype=np.int32)
+    else:
+        # position of each output ID in the table of distinct words
+        starts = np.cumsum(lengths) - lengths
+        counts = lengths[word_index]
+        offsets = np.cumsum(counts) - counts
+        sequence = ids[np.repeat(starts[word_index] - offsets, counts) + np.arange(offsets[-1] + counts[-1])]
+
+    if verbose:
+        print("Raw Text Sequence: {}".format(text))
+        print("Phoneme Sequence: {}".format(sequence_to_text(sequence)))
+
+    return sequence
+
+
+def split_sentences(text):
+    """ split text after sentence punctuation, dropping empty sentences """
+    sentences = re.split(r"(?<=[.;:\?\!])\s+", text.strip())
+    return [s for s in sentences if s.strip(punctuation + " ")]
+
+
+def synthesize_stream(lexicon, g2p, text, model, preprocess_config, chunk_size=32, verbose=False):
+    """
+    Synthesize text sentence by sentence and yield int16 PCM chunks as soon as
+    they are vocoded. Only one sentence is held in memory at a time.
+
+    Args:
+        model: EfficientSpeech in eval mode
+        chunk_size: mel frames per yielded chunk
+
+    Yields:
+        1D int16 np.ndarray of chunk_size * hop_length samples, shorter at the
+        end of each sentence
+    """
+    max_wav_value = preprocess_config["preprocessing"]["audio"]["max_wav_value"]
+    sampling_rate = preprocess_config["preprocessing"]["audio"]["sampling_rate"]
+
+    sentences = split_sentences(text.replace('-', ' '))
+    if isinstance(g2p, CachedG2p):
+        # OOV words of all the sentences in one G2P batch
+        g2p.convert([w for sentence in sentences for w in oov_words(lexicon, sentence, preprocess_config)])
+
+    start_time = time.time()
+    chunk_start = start_time
+    first_chunk = True
+    for sentence in sentences:
+        phoneme = text2sequence(lexicon, g2p, sentence, preprocess_config, verbose=verbose)
+        phoneme = torch.from_numpy(phoneme).long().unsqueeze(0).to(model.device)
+        with torch.no_grad():
+            for wav in model.predict_stream({"phoneme": phoneme}, chunk_size=chunk_size):
+                wav = wav[0].cpu().numpy() * max_wav_value
+                wav = np.clip(wav, -max_wav_value, max_wav_value - 1).astype("int16")
+                if verbose:
+                    elapsed_time = time.time() - chunk_start
+                    if first_chunk:
+                        print("Time to first chunk: {:.4f}s".format(time.time() - start_time))
+                    print("Chunk: {} samples, time: {:.4f}s, real time factor: {:.2f}".format(
+                        len(wav), elapsed_time, len(wav) / sampling_rate / elapsed_time))
+                first_chunk = False
+                yield wav
+                # do not count the time spent by the consumer
+                chunk_start = time.time()
+
+
 def synthesize(lexicon, g2p, args, phoneme2mel, hifigan, preprocess_config, verbose=False):
     assert(args.text is not None)
 
     if verbose:
         start_time = time.time()
     
-    phoneme = np.array([text2phoneme(lexicon, g2p, args.text, preprocess_config)])
+    phoneme = text2sequence(lexicon, g2p, args.text, preprocess_config)[None]
     phoneme_len = np.array([len(phoneme[0])])
 
     phoneme = torch.from_numpy(phoneme).long()  
@@ -0,0 +1,254 @@
+"""
+Batched and memoised G2P for out of vocabulary words.
+
+g2p_batch(g2p, words) gives the same phones as [g2p(w) for w in words] for
+a g2p_en.G2p, but the neural model runs once for all the words that need it
+and the POS tagger is loaded once, only for words with homographs.
+
+CachedG2p keeps the phones of the last max_size words and can save them
+to disk so they survive restarts.
+
+LazyG2p imports g2p_en and creates the G2p on the first word that needs it,
+optionally from a local NLTK data directory so that nothing is downloaded.
+"""
+
+import json
+import os
+import re
+import sys
+import time
+import unicodedata
+import numpy as np
+
+from collections import OrderedDict
+
+
+def _strip(text):
+    text = ''.join(char for char in unicodedata.normalize('NFD', text)
+                   if unicodedata.category(char) != 'Mn')  # Strip accents
+    text = text.lower()
+    return re.sub("[^ a-z'.,?!\\-]", "", text)
+
+
+def _normalize(text):
+    # preprocessing of G2p.__call__
+    from g2p_en.expand import normalize_numbers
+
+    text = _strip(normalize_numbers(str(text)))
+    text = text.replace("i.e.", "that is")
+    text = text.replace("e.g.", "for example")
+    return text
+
+
+def _trivial_phones(word):
+    """
+    Phones G2p gives to delimiters and punctuation without loading it: []
+    or the punctuation itself. None for other words.
+    """
+    if any(char.isalnum() for char in word):
+        return None
+    # numbers are not expanded without digits
+    tokens = _strip(word).split()
+    # a single punctuation is a single token
+    if len(tokens) == 0 or (len(tokens) == 1 and len(tokens[0]) == 1):
+        return tokens
+    return None
+
+
+def predict_batch(g2p, words):
+    """ G2p.predict for a list of words, as one batch """
+    if len(words) == 0:
+        return []
+    batch = len(words)
+    steps = max(len(word) for word in words) + 1
+    # graphemes and </s>, padded with <pad>
+    x = np.zeros((batch, steps), dtype=np.int64)
+    for i, word in enumerate(words):
+        chars = list(word) + ["</s>"]
+        x[i, :len(chars)] = [g2p.g2idx.get(char, g2p.g2idx["<unk>"]) for char in chars]
+    x = np.take(g2p.enc_emb, x, axis=0)
+
+    enc = g2p.gru(x, steps, g2p.enc_w_ih, g2p.enc_w_hh, g2p.enc_b_ih, g2p.enc_b_hh,
+                  h0=np.zeros((batch, g2p.enc_w_hh.shape[-1]), np.float32))
+    # hidden state after the </s> of each word
+    h = enc[np.arange(batch), [len(word) for word in words]]
+
+    dec = np.take(g2p.dec_emb, [2] * batch, axis=0)  # 2: <s>
+    preds = [[] for _ in words]
+    done = np.zeros(batch, dtype=bool)
+    for _ in range(20):
+        h = g2p.grucell(dec, h, g2p.dec_w_ih, g2p.dec_w_hh, g2p.dec_b_ih, g2p.dec_b_hh)
+        logits = np.matmul(h, g2p.fc_w.T) + g2p.fc_b
+        pred = logits.argmax(-1)
+        done |= pred == 3  # 3: </s>
+        if done.all():
+            break
+        for i in np.flatnonzero(~done):
+            preds[i].append(pred[i])
+        dec = np.take(g2p.dec_emb, pred, axis=0)
+
+    return [[g2p.idx2p.get(idx, "<unk>") for idx in p] for p in preds]
+
+
+def g2p_batch(g2p, words):
+    """
+    Same as [g2p(w) for w in words]. A CachedG2p converts only the words it
+    has not seen and a g2p_en.G2p converts the words as one batch. Other
+    G2P callables are called word by word.
+    """
+    if len(words) == 0:
+        return []
+    if isinstance(g2p, (CachedG2p, LazyG2p)):
+        return g2p.convert(words)
+
+    # importing g2p_en can download NLTK data, a G2p exists only if it is imported
+    g2p_en = sys.modules.get("g2p_en")
+    if g2p_en is None or not isinstance(g2p, g2p_en.G2p):
+        return [g2p(w) for w in words]
+
+    from g2p_en.g2p import word_tokenize
+    from nltk import pos_tag_sents
+
+    tokens = [word_tokenize(_normalize(w)) for w in words]
+    # POS tags are only used for homographs
+    homographs = [i for i, t in enumerate(tokens) if any(token in g2p.homograph2features for token in t)]
+    tags = {i: [pos for _, pos in tagged] for i, tagged in zip(homographs, pos_tag_sents([tokens[i] for i in homographs]))}
+    oov = sorted({token for t in tokens for token in t if re.search("[a-z]", token) is not None
+                  and token not in g2p.homograph2features and token not in g2p.cmu})
+    predictions = dict(zip(oov, predict_batch(g2p, oov)))
+
+    results = []
+    for i, t in enumerate(tokens):
+        prons = []
+        for j, token in enumerate(t):
+            if re.search("[a-z]", token) is None:
+                pron = [token]
+            elif token in g2p.homograph2features:
+                pron1, pron2, pos1 = g2p.homograph2features[token]
+                pron = pron1 if tags[i][j].startswith(pos1) else pron2
+            elif token in g2p.cmu:
+                pron = g2p.cmu[token][0]
+            else:
+                pron = predictions[token]
+            prons.extend(pron)
+            prons.extend([" "])
+        results.append(prons[:-1])
+    return results
+
+
+def load_g2p(data_path=None):
+    """
+    g2p_en.G2p(). Importing g2p_en downloads the NLTK cmudict and POS tagger
+    if they are not found. With data_path, a local NLTK data directory with
+    cmudict, averaged_perceptron_tagger and, for NLTK 3.9 or later, 
+    averaged_perceptron_tagger_eng, nothing is downloaded and a missing 
+    resource is an error.
+    """
+    if data_path is not None:
+        import nltk
+        from nltk.tag.perceptron import PerceptronTagger
+
+        if data_path not in nltk.data.path:
+            nltk.data.path.insert(0, data_path)
+        # g2p_en looks for averaged_perceptron_tagger at import, pos_tag of
+        # NLTK 3.9 or later loads averaged_perceptron_tagger_eng instead
+        resources = ["corpora/cmudict.zip", "taggers/averaged_perceptron_tagger.zip"]
+        if hasattr(PerceptronTagger, "load_from_json"):
+            resources.append("taggers/averaged_perceptron_tagger_eng/")
+        for resource in resources:
+            try:
+                nltk.data.find(resource)
+            except LookupError:
+                name = resource.rstrip("/").split("/")[-1].replace(".zip", "")
+                raise FileNotFoundError("{} not found in {}, get it with nltk.download('{}', '{}')"
+                                        .format(resource, data_path, name, data_path))
+
+    from g2p_en import G2p
+    return G2p()
+
+
+class LazyG2p:
+    """
+    G2P callable that loads g2p_en.G2p on the first word that needs it.
+    Delimiters and single punctuation, which G2p gives back as they are,
+    do not load it.
+
+    Args:
+        data_path: optional local NLTK data directory, see load_g2p
+        verbose: print the load time
+    """
+    def __init__(self, data_path=None, verbose=False):
+        self.data_path = data_path
+        self.verbose = verbose
+        self.g2p = None
+        # seconds taken to load the G2p, 0 until it is loaded
+        self.load_time = 0.
+
+    def load(self):
+        if self.g2p is None:
+            start_time = time.time()
+            self.g2p = load_g2p(self.data_path)
+            self.load_time = time.time() - start_time
+            if self.verbose:
+                print("G2P load time: {:.2f}s".format(self.load_time))
+        return self.g2p
+
+    def __call__(self, word):
+        return self.convert([word])[0]
+
+    def convert(self, words):
+        words = list(words)
+        phones = {w: _trivial_phones(w) for w in dict.fromkeys(words)}
+        todo = [w for w, p in phones.items() if p is None]
+        if len(todo) > 0:
+            phones.update(zip(todo, g2p_batch(self.load(), todo)))
+        return [list(phones[w]) for w in words]
+
+
+class CachedG2p:
+    """
+    G2P with a bounded LRU cache of word -> phones.
+
+    Args:
+        g2p: G2P callable, eg LazyG2p() or g2p_en.G2p()
+        max_size: most words kept, the least recently used are dropped first
+        path: optional json file, loaded if it exists and written by save()
+    """
+    def __init__(self, g2p, max_size=65536, path=None):
+        self.g2p = g2p
+        self.max_size = max_size
+        self.path = path
+        self.cache = OrderedDict()
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                # least recently used first
+                for word, phones in json.load(f):
+                    self.cache[word] = phones
+            self._evict()
+
+    def _evict(self):
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+    def __call__(self, word):
+        return self.convert([word])[0]
+
+    def convert(self, words):
+        """ phones of each word, words not in the cache are converted in one batch """
+        misses = [w for w in dict.fromkeys(words) if w not in self.cache]
+        phones = dict(zip(misses, g2p_batch(self.g2p, misses)))
+        for w in words:
+            if w in self.cache:
+                self.cache.move_to_end(w)
+                phones[w] = self.cache[w]
+        self.cache.update(phones)
+        self._evict()
+        return [list(phones[w]) for w in words]
+
+    def save(self, path=None):
+        """ write the cache to path or self.path """
+        path = self.path if path is None else path
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(list(self.cache.items()), f)
+        os.replace(tmp_path, path)
@@ -0,0 +1,222 @@
+"""
+Compiled lexicon: a binary file with a hash index over the words and their
+phoneme ID sequences, loaded with mmap. Loading takes milliseconds and the
+pages are shared by all the processes that load the same file.
+
+Compile a text lexicon (word phone phone ...):
+    python3 -m text.lexicon lexicon/librispeech-lexicon.txt lexicon/librispeech-lexicon.bin
+
+and set lexicon_path in the preprocess config to the .bin file.
+"""
+
+import mmap
+import re
+import struct
+import zlib
+import numpy as np
+
+from collections.abc import Mapping
+from text import _symbol_to_id, _should_keep_symbol
+
+MAGIC = b"ESLX"
+VERSION = 1
+# magic, version, number of words, hash table size
+_header = struct.Struct("<4sIII")
+# phones that text2phoneme replaces with {sp}: empty or a single punctuation
+_silence_re = re.compile(r"[^\w\s]?")
+
+
+# phone -> ID, or -1 if text_to_sequence drops it. filled on first use
+_phone_to_id = {}
+
+
+def phone_to_id(phone):
+    """ ID text2phoneme gives to a phone without braces, or -1 if it is dropped """
+    if phone not in _phone_to_id:
+        s = "@" + ("sp" if _silence_re.fullmatch(phone) else phone)
+        _phone_to_id[phone] = _symbol_to_id[s] if _should_keep_symbol(s) else -1
+    return _phone_to_id[phone]
+
+
+def phones_to_sequence(phones):
+    """ IDs of the phones of a word, the same as text2phoneme gives for them """
+    ids = [_phone_to_id.get(p) for p in phones]
+    if None in ids:
+        ids = [phone_to_id(p) for p in phones]
+    if -1 in ids:
+        ids = [i for i in ids if i >= 0]
+    return ids
+
+
+def phones_to_ids(phones):
+    """ int32 phone_to_id of each phone, -1 where text2phoneme drops the phone """
+    ids = list(map(_phone_to_id.get, phones))
+    if None in ids:
+        ids = list(map(phone_to_id, phones))
+    return np.array(ids, dtype=np.int32)
+
+
+def read_text_lexicon(lex_path):
+    """ word -> phones, the 1st entry of a word wins, as in synthesize.read_lexicon """
+    lexicon = {}
+    with open(lex_path) as f:
+        for line in f:
+            temp = re.split(r"\s+", line.strip("\n"))
+            word = temp[0]
+            phones = temp[1:]
+            if word.lower() not in lexicon:
+                lexicon[word.lower()] = phones
+    return lexicon
+
+
+def _hash(key):
+    return zlib.crc32(key)
+
+
+def compile_lexicon(lex_path, out_path):
+    """
+    Compile a text lexicon to a binary lexicon. Layout, all little endian
+    and 4 byte aligned:
+        header
+        table       uint32[size], word index + 1 at its slot, 0 if empty
+        key_offsets uint32[n + 1], into keys
+        id_offsets  uint32[n + 1], into ids
+        text_offsets uint32[n + 1], into phones
+        ids         int32[...], phoneme IDs
+        keys        utf-8 words
+        phones      utf-8 phones of the text lexicon, each followed by a space
+    Collisions are resolved with linear probing.
+
+    Returns:
+        number of words
+    """
+    lexicon = read_text_lexicon(lex_path)
+    words = [w.encode("utf-8") for w in lexicon]
+    n = len(words)
+    size = 1
+    while size < 2 * n:
+        size *= 2
+
+    table = np.zeros(size, dtype=np.uint32)
+    for i, key in enumerate(words):
+        slot = _hash(key) & (size - 1)
+        while table[slot] != 0:
+            slot = (slot + 1) & (size - 1)
+        table[slot] = i + 1
+
+    sequences = [phones_to_sequence(phones) for phones in lexicon.values()]
+    key_offsets = np.cumsum([0] + [len(key) for key in words], dtype=np.uint32)
+    id_offsets = np.cumsum([0] + [len(s) for s in sequences], dtype=np.uint32)
+    ids = np.array([i for s in sequences for i in s], dtype=np.int32)
+    # each phone is followed by a space, so [] and [""] are kept apart
+    phones = ["".join(p + " " for p in phones).encode("utf-8") for phones in lexicon.values()]
+    text_offsets = np.cumsum([0] + [len(p) for p in phones], dtype=np.uint32)
+
+    with open(out_path, "wb") as f:
+        f.write(_header.pack(MAGIC, VERSION, n, size))
+        for array in [table, key_offsets, id_offsets, text_offsets, ids]:
+            f.write(array.tobytes())
+        f.write(b"".join(words))
+        f.write(b"".join(phones))
+    return n
+
+
+class CompiledLexicon(Mapping):
+    """
+    Read only word -> phones mapping over a compiled lexicon. It can be used
+    in place of the dict of read_lexicon. ids(word) gives the phoneme IDs
+    without copying them.
+    """
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n, size = _header.unpack_from(self._mmap)
+        assert magic == MAGIC and version == VERSION, "{} is not a compiled lexicon".format(path)
+        self._n = n
+        self._size = size
+
+        offset = _header.size
+        self._table = np.frombuffer(self._mmap, dtype=np.uint32, count=size, offset=offset)
+        offset += 4 * size
+        self._key_offsets = np.frombuffer(self._mmap, dtype=np.uint32, count=n + 1, offset=offset)
+        offset += 4 * (n + 1)
+        self._id_offsets = np.frombuffer(self._mmap, dtype=np.uint32, count=n + 1, offset=offset)
+        offset += 4 * (n + 1)
+        self._text_offsets = np.frombuffer(self._mmap, dtype=np.uint32, count=n + 1, offset=offset)
+        offset += 4 * (n + 1)
+        self._ids = np.frombuffer(self._mmap, dtype=np.int32, count=int(self._id_offsets[-1]), offset=offset)
+        # byte offsets of the keys and phones blobs
+        self._keys = offset + 4 * len(self._ids)
+        self._phones = self._keys + int(self._key_offsets[-1])
+        # memoryviews give python ints faster than numpy for the hash lookups
+        self._table_view = memoryview(self._table).cast("B").cast("I")
+        self._key_offsets_view = memoryview(self._key_offsets).cast("B").cast("I")
+
+    def _key(self, i):
+        start = self._keys + self._key_offsets_view[i]
+        end = self._keys + self._key_offsets_view[i + 1]
+        return self._mmap[start:end]
+
+    def _text(self, i):
+        start = self._phones + int(self._text_offsets[i])
+        end = self._phones + int(self._text_offsets[i + 1])
+        return self._mmap[start:end].decode("utf-8")
+
+    def index(self, word):
+        """ index of word or -1 """
+        key = word.encode("utf-8")
+        slot = _hash(key) & (self._size - 1)
+        while True:
+            i = self._table_view[slot] - 1
+            if i < 0 or self._key(i) == key:
+                return i
+            slot = (slot + 1) & (self._size - 1)
+
+    def ids(self, word):
+        """ int32 phoneme IDs of word, a read only view, or None """
+        i = self.index(word)
+        if i < 0:
+            return None
+        return self._ids[self._id_offsets[i]:self._id_offsets[i + 1]]
+
+    def __getitem__(self, word):
+        i = self.index(word)
+        if i < 0:
+            raise KeyError(word)
+        return self._text(i).split(" ")[:-1]
+
+    def __contains__(self, word):
+        return isinstance(word, str) and self.index(word) >= 0
+
+    def __len__(self):
+        return self._n
+
+    def __iter__(self):
+        for i in range(self._n):
+            yield self._key(i).decode("utf-8")
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Compile a text lexicon to a binary lexicon")
+    parser.add_argument("lexicon", help="text lexicon, eg lexicon/librispeech-lexicon.txt")
+    parser.add_argument("output", help="compiled lexicon, eg lexicon/librispeech-lexicon.bin")
+    args = parser.parse_args()
+
+    start_time = time.time()
+    n = compile_lexicon(args.lexicon, args.output)
+    print("Compiled {} words to {} in {:.2f}s".format(n, args.output, time.time() - start_time))
+
+    # both lexicons give the same phoneme IDs for every word
+    start_time = time.time()
+    lexicon = CompiledLexicon(args.output)
+    print("Load time: {:.4f}s".format(time.time() - start_time))
+    start_time = time.time()
+    text_lexicon = read_text_lexicon(args.lexicon)
+    print("Text lexicon load time: {:.4f}s".format(time.time() - start_time))
+    for word, phones in text_lexicon.items():
+        assert lexicon[word] == phones, word
+        assert lexicon.ids(word).tolist() == phones_to_sequence(phones), word
+    print("Verified {} words".format(len(text_lexicon)))
@@ -17,10 +17,9 @@ from scipy.io import wavfile
 from matplotlib import pyplot as plt
 
 def write_to_file(wavs, preprocess_config, lengths=None, wav_path="outputs", filename="tts"):
-    wavs = (
-            wavs * preprocess_config["preprocessing"]["audio"]["max_wav_value"]
-            ).astype("int16")
-    wavs = [wav for wav in wavs]
+    # wavs: (B, T) array or list of B 1D arrays
+    max_wav_value = preprocess_config["preprocessing"]["audio"]["max_wav_value"]
+    wavs = [(wav * max_wav_value).astype("int16") for wav in wavs]
     sampling_rate = preprocess_config["preprocessing"]["audio"]["sampling_rate"]
     if lengths is not None:
         lengths *= preprocess_config["preprocessing"]["stft"]["hop_length"]
@@ -45,7 +44,7 @@ def get_mask_from_lengths(lengths, max_len=None):
     if max_len is None:
         max_len = torch.max(lengths).item()
 
-    ids = torch.arange(0, max_len).unsqueeze(0).expand(batch_size, -1) #.to(device)
+    ids = torch.arange(0, max_len, device=lengths.device).unsqueeze(0).expand(batch_size, -1)
     mask = ids >= lengths.unsqueeze(1).expand(-1, max_len)
 
     return mask
@@ -88,7 +87,13 @@ def vocoder_infer(mels, vocoder, preprocess_config, lengths=None, verbose=False)
         start_time = time.time()
     
     with torch.no_grad():
-        wavs = vocoder(mels).squeeze(1)
+        if lengths is not None and len(mels) > 1:
+            # lengths are in samples
+            hop_length = preprocess_config["preprocessing"]["stft"]["hop_length"]
+            frames = [int(length) // hop_length for length in lengths]
+            wavs, _ = vocode_batches(mels, frames, vocoder, verbose=verbose)
+        else:
+            wavs = vocoder(mels).squeeze(1)
 
     if verbose:
         elapsed_time = time.time() - start_time
@@ -97,11 +102,8 @@ def vocoder_infer(mels, vocoder, preprocess_config, lengths=None, verbose=False)
     if verbose:
         start_time = time.time()
 
-    wavs = (
-        wavs.cpu().numpy()
-        * preprocess_config["preprocessing"]["audio"]["max_wav_value"]
-    ).astype("int16")
-    wavs = [wav for wav in wavs]
+    max_wav_value = preprocess_config["preprocessing"]["audio"]["max_wav_value"]
+    wavs = [(wav.cpu().numpy() * max_wav_value).astype("int16") for wav in wavs]
 
     for i in range(len(mels)):
         if lengths is not None:
@@ -114,6 +116,81 @@ def vocoder_infer(mels, vocoder, preprocess_config, lengths=None, verbose=False)
     return wavs
 
 
+def sort_batches(lengths, max_waste=0.1, max_frames=4096):
+    """
+    Group mels into micro-batches of similar length for the vocoder.
+
+    Mels are sorted by decreasing length and added to the current batch as
+    long as its padded size (batch size x longest length) is at most 
+    max_frames and at most max_waste of it is padding.
+
+    Args:
+        lengths: list of mel lengths in frames
+        max_waste: largest fraction of padding frames in a batch
+        max_frames: largest padded size of a batch, in frames
+
+    Returns:
+        list of batches, each a list of indices into lengths, longest first
+    """
+    order = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+    batches = []
+    batch = []
+    total = 0
+    for i in order:
+        if len(batch) > 0:
+            padded = (len(batch) + 1) * lengths[batch[0]]
+            if padded > max_frames or total + lengths[i] < (1 - max_waste) * padded:
+                batches.append(batch)
+                batch = []
+                total = 0
+        batch.append(i)
+        total += lengths[i]
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+def vocode_batches(mels, lengths, vocoder, max_waste=0.1, max_frames=4096, verbose=False):
+    """
+    Vocode a padded batch of mels in length-sorted micro-batches (see
+    sort_batches) so that little of the vocoder compute is spent on padding.
+    Padded frames are masked so each wav is the same as if vocoded alone.
+
+    Args:
+        mels: (B, 80, T) padded mels
+        lengths: B mel lengths in frames
+        vocoder: hifigan Generator or FrozenGenerator
+
+    Returns:
+        list of B 1D wavs in the input order, trimmed to length * hop_length
+        padding efficiency, the fraction of the vocoded frames that are not padding
+    """
+    lengths = [int(length) for length in lengths]
+    hop_length = vocoder.hop_length()
+    wavs = [None] * len(lengths)
+    batches = sort_batches(lengths, max_waste=max_waste, max_frames=max_frames)
+    padded = 0
+    with torch.no_grad():
+        for batch in batches:
+            longest = lengths[batch[0]]
+            mel = mels[batch, :, :longest]
+            mask = None
+            if lengths[batch[-1]] < longest:
+                batch_lengths = torch.tensor([lengths[i] for i in batch], device=mel.device)
+                mask = get_mask_from_lengths(batch_lengths, longest).unsqueeze(1)
+            wav = vocoder(mel, mask=mask).squeeze(1)
+            for i, w in zip(batch, wav):
+                wavs[i] = w[:lengths[i] * hop_length]
+            padded += len(batch) * longest
+
+    efficiency = sum(lengths) / max(padded, 1)
+    if verbose:
+        print("(HiFiGAN) {} mels in {} micro-batches, padding efficiency: {:.2f} (single batch: {:.2f})".format(
+              len(lengths), len(batches), efficiency,
+              sum(lengths) / max(len(lengths) * max(lengths, default=0), 1)))
+    return wavs, efficiency
+
+
 def synth_test_samples(mel,
                        mel_len,
                        mel_pred,
@@ -321,7 +398,8 @@ def get_args():
     
     parser.add_argument("--devices", type=int, default=1)
     parser.add_argument("--iter", type=int, default=1)
-    parser.add_argument("--threads", type=int, default=24)
+    parser.add_argument("--threads", type=int, default=None,
+                        help="cpu threads, default 24 for torch and the onnxruntime default for onnx")
     
     #choices = ["bf16-mixed", "16-mixed", 16, 32, 64]
     parser.add_argument("--precision", default=16)
@@ -435,10 +513,26 @@ def get_args():
                         type=str,
                         default=None,
                         help='Convert to onnx model')
+    parser.add_argument('--onnx-vocoder',
+                        type=str,
+                        default=None,
+                        help='Vocoder onnx model. If set, the acoustic model and vocoder are separate onnx models')
+    parser.add_argument('--hifigan-frozen',
+                        type=str,
+                        default=None,
+                        help='Save an inference only HiFi-GAN with folded weights to this path')
+    parser.add_argument('--hifigan-grouped',
+                        type=int,
+                        nargs='*',
+                        default=[],
+                        help='Upsampling levels of the frozen HiFi-GAN that run the resblocks as grouped convs')
+    parser.add_argument('--freeze-vocoder',
+                        action='store_true',
+                        help='Inference with the HiFi-GAN of the checkpoint folded into a frozen HiFi-GAN')
     parser.add_argument('--onnx-insize',
                         type=int,
                         default=128,
-                        help='Max input size for the onnx model')
+                        help='Phoneme length of the sample input used for onnx export')
     parser.add_argument('--onnx-opset',
                         type=int,
                         default=14,
@@ -461,9 +555,53 @@ def get_args():
     parser.add_argument('--compile',
                         action='store_true',
                         help='Train using the compiled model')
+    parser.add_argument('--compile-cache',
+                        type=str,
+                        default=os.path.join("~", ".cache", "efficientspeech"),
+                        help='Folder of the persistent compile cache used by --compile during inference')
     parser.add_argument('--play',
                         action='store_true',
                         help='Playback the generated audio. Do not save it to disk.')
+    parser.add_argument('--stream',
+                        action='store_true',
+                        help='Synthesize sentence by sentence and play or save the audio chunks as they are ready')
+    parser.add_argument('--encoder-window',
+                        type=int,
+                        default=1024,
+                        help='Longer phoneme sequences are encoded in overlapping windows of this length. 0 to disable')
+    parser.add_argument('--channels-last',
+                        action='store_true',
+                        help='Inference with the mel decoder converted to the channels_last layout')
+    parser.add_argument('--polyphase',
+                        action='store_true',
+                        help='Run the transposed convs of the vocoder and Fuse as polyphase convs. Faster without mkldnn, eg arm')
+    parser.add_argument('--sparse',
+                        action='store_true',
+                        help='Do not vocode long silent spans ({sp} phonemes), splice in precomputed silence')
+    parser.add_argument('--silence-energy',
+                        type=float,
+                        default=None,
+                        help='With --sparse, phonemes with a lower predicted normalized energy are also silent')
+    parser.add_argument('--vocoder-workers',
+                        type=int,
+                        default=None,
+                        help='Vocode long utterances in overlapping chunks on this many worker threads')
+    parser.add_argument('--vocoder-threads',
+                        type=int,
+                        default=1,
+                        help='Intra-op threads per vocoder worker')
+    parser.add_argument('--g2p-cache',
+                        type=str,
+                        default=None,
+                        help='Json file that keeps the G2P phones of out of vocabulary words across runs')
+    parser.add_argument('--g2p-data',
+                        type=str,
+                        default=None,
+                        help='Local NLTK data directory with cmudict, averaged_perceptron_tagger and, for NLTK 3.9 or later, averaged_perceptron_tagger_eng, nothing is downloaded')
+    parser.add_argument('--chunk-size',
+                        type=int,
+                        default=32,
+                        help='Mel frames per streamed audio chunk')
     
     args = parser.parse_args()
 